@@ -29,7 +29,7 @@
 {
     'name': 'Recurring contract',
     'summary': 'Contract for recurring invoicing',
-    'version': '12.0.1.1.0',
+    'version': '12.0.1.2.0',
     'license': 'AGPL-3',
     'author': 'Compassion CH',
     'development_status': 'Production/Stable',
@@ -51,11 +51,23 @@
         'views/recurring_invoicer_view.xml',
         'views/recurring_invoicer_wizard_view.xml',
         'views/utm_medium_view.xml',
+        'views/contract_line_reprice_wizard_view.xml',
+        'views/reconcile_run_view.xml',
+        'views/res_config_settings_view.xml',
+        'views/res_partner_view.xml',
+        'views/contract_kpi_view.xml',
+        'views/contract_import_wizard_view.xml',
+        'views/contract_reassign_wizard_view.xml',
         'data/recurring_contract_sequence.xml',
         'data/contract_expire_cron.xml',
+        'data/arrears_cron.xml',
+        'data/archive_cron.xml',
         'data/daily_invoicer_cron.xml',
+        'data/contract_kpi_cron.xml',
+        'data/reconcile_cron.xml',
         'data/utm_data.xml',
         'data/queue_job.xml',
+        'data/config_parameter.xml',
         'security/ir.model.access.csv',
         'security/security.xml',
     ],
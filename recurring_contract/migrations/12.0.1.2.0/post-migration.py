@@ -0,0 +1,20 @@
+##############################################################################
+#
+#    Copyright (C) 2021 Compassion CH (http://www.compassion.ch)
+#    Releasing children from poverty in Jesus' name
+#
+#    The licence is in the file __manifest__.py
+#
+##############################################################################
+from odoo import api, SUPERUSER_ID
+
+
+def migrate(cr, version):
+    if not version:
+        return
+    # Fill the last paid invoice dates and arrears which are now stored
+    env = api.Environment(cr, SUPERUSER_ID, {})
+    contracts = env['recurring.contract'].with_context(
+        active_test=False).search([])
+    contracts._update_last_paid_invoice_date()
+    contracts._update_arrears()
@@ -6,3 +6,11 @@ from . import recurring_contract_line
 from . import utm
 from . import end_reason
 from . import move_line
+from . import reconcile_run
+from . import res_company
+from . import res_config_settings
+from . import account_account
+from . import partner_credit
+from . import account_move
+from . import res_partner
+from . import contract_state_history
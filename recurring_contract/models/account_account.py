@@ -0,0 +1,35 @@
+##############################################################################
+#
+#    Copyright (C) 2021 Compassion CH (http://www.compassion.ch)
+#    Releasing children from poverty in Jesus' name
+#
+#    The licence is in the file __manifest__.py
+#
+##############################################################################
+
+from odoo import api, models
+
+
+class AccountAccount(models.Model):
+    """ Invalidate the resolved transit accounts when account codes change.
+    """
+    _inherit = 'account.account'
+
+    @api.model
+    def create(self, vals):
+        res = super().create(vals)
+        self.env['res.company'].clear_caches()
+        return res
+
+    @api.multi
+    def write(self, vals):
+        res = super().write(vals)
+        if 'code' in vals or 'company_id' in vals:
+            self.env['res.company'].clear_caches()
+        return res
+
+    @api.multi
+    def unlink(self):
+        res = super().unlink()
+        self.env['res.company'].clear_caches()
+        return res
@@ -0,0 +1,43 @@
+##############################################################################
+#
+#    Copyright (C) 2021 Compassion CH (http://www.compassion.ch)
+#    Releasing children from poverty in Jesus' name
+#
+#    The licence is in the file __manifest__.py
+#
+##############################################################################
+
+from odoo import api, models
+
+
+class AccountMove(models.Model):
+    """ Keep the open credit of partners up to date when payments are
+    posted or cancelled. """
+    _inherit = 'account.move'
+
+    @api.multi
+    def post(self, invoice=False):
+        res = super().post(invoice)
+        self._refresh_partner_credit()
+        return res
+
+    @api.multi
+    def button_cancel(self):
+        res = super().button_cancel()
+        self._refresh_partner_credit()
+        return res
+
+    @api.multi
+    def unlink(self):
+        partner_ids = self.mapped('line_ids.partner_id').ids
+        res = super().unlink()
+        self.env['recurring.partner.credit'].refresh_open_credit(partner_ids)
+        return res
+
+    def _refresh_partner_credit(self):
+        transit_account_ids = self.env[
+            'res.company'].get_transit_account_ids()
+        partners = self.mapped('line_ids').filtered(
+            lambda l: l.account_id.id in transit_account_ids
+        ).mapped('partner_id')
+        self.env['recurring.partner.credit'].refresh_open_credit(partners.ids)
@@ -41,8 +41,7 @@ class ContractGroup(models.Model):
         track_visibility='onchange', readonly=False
     )
     last_paid_invoice_date = fields.Date(
-        compute='_compute_last_paid_invoice',
-        string='Last paid invoice date')
+        string='Last paid invoice date', readonly=True, copy=False)
 
     change_method = fields.Selection(
         '_get_change_methods', default='do_nothing')
@@ -61,16 +60,6 @@ class ContractGroup(models.Model):
     contract_ids = fields.One2many(
         'recurring.contract', 'group_id', 'Contracts', readonly=True)
 
-    ##########################################################################
-    #                             FIELDS METHODS                             #
-    ##########################################################################
-    def _compute_last_paid_invoice(self):
-        for group in self:
-            group.last_paid_invoice_date = max(
-                [c.last_paid_invoice_date for c in group.contract_ids
-                 if c.last_paid_invoice_date] or
-                [False])
-
     ##########################################################################
     #                              ORM METHODS                               #
     ##########################################################################
@@ -83,14 +72,18 @@ class ContractGroup(models.Model):
             - Recurring value or unit changes
             - Another change method was selected
         """
-        res = True
+        # Split the groups by the method to apply changes, so that each
+        # partition is written and processed at once.
+        partitions = dict()
         for group in self:
-            # Get the method to apply changes
             change_method = vals.get('change_method', group.change_method)
-            change_method = getattr(group, change_method)
+            partitions.setdefault(change_method, self.browse())
+            partitions[change_method] |= group
 
-            res = super(ContractGroup, group).write(vals) & res
-            change_method()
+        res = True
+        for change_method, groups in partitions.items():
+            res = super(ContractGroup, groups).write(vals) & res
+            getattr(groups, change_method)()
 
         return res
 
@@ -104,7 +97,8 @@ class ContractGroup(models.Model):
             the task immediately.
         """
         if self.env.context.get('async_mode', True):
-            self.with_delay()._clean_generate_invoices()
+            for groups in self._split_in_chunks():
+                groups.with_delay()._clean_generate_invoices()
         else:
             self._clean_generate_invoices()
         return True
@@ -157,6 +151,22 @@ class ContractGroup(models.Model):
     ##########################################################################
     #                             PRIVATE METHODS                            #
     ##########################################################################
+    @api.model
+    def _get_job_chunk_size(self):
+        """ Number of records processed by a single job, configurable with
+        the system parameter recurring_contract.job_chunk_size. """
+        return int(self.env['ir.config_parameter'].sudo().get_param(
+            'recurring_contract.job_chunk_size', 100)) or 100
+
+    @api.multi
+    def _split_in_chunks(self, size=None):
+        """ Split the recordset in chunks processed by separate jobs.
+        :param size: optional chunk size (defaults to the configured one)
+        :return: list of recordsets
+        """
+        size = size or self._get_job_chunk_size()
+        return [self[i:i + size] for i in range(0, len(self), size)]
+
     @api.multi
     def _generate_invoices(self, invoicer=None, cancelled_invoices=None):
         """ Checks all contracts and generate invoices if needed.
@@ -236,29 +246,208 @@ class ContractGroup(models.Model):
 
     @api.multi
     def _clean_generate_invoices(self):
-        """ Change method which cancels generated invoices and rewinds
-        the next_invoice_date of contracts, so that new invoices can be
-        generated taking into consideration the modifications of the
-        contract group.
+        """ Change method which regenerates the invoices of the groups so
+        that they take into consideration the modifications of the contract
+        group. The target invoice set is computed once for each group and
+        compared with the existing invoices, so that only the needed
+        operations are applied:
+            - existing open invoices that already match are kept untouched
+            - existing open or cancelled invoices at a target date are
+              rewritten (and reopened)
+            - missing invoices are created
+            - open invoices outside the target set are cleaned
+        :return: invoices that were modified
         """
         res = self.env['account.invoice']
-        for group in self:
-            # invoice for current contract might not be up to date.
-            # since we are changing the value of next_invoice_date
-            # this might cause some issue if we don't first generate the missing one.
-            next_invoice_date = min(group.mapped("contract_ids").filtered(
-                "next_invoice_date").mapped("next_invoice_date"))
-            if next_invoice_date and next_invoice_date <= date.today():
-                group._generate_invoices()
-
-            res |= group.contract_ids.with_context(
-                async_mode=False).rewind_next_invoice_date()
-        # Generate again invoices
-        self._generate_invoices(invoicer=None, cancelled_invoices=res.filtered(
-            lambda inv: inv.state == "cancel"
-        ))
+        invoicer = self.env['recurring.invoicer'].create({})
+        nb_groups = len(self)
+        for count, group in enumerate(self, start=1):
+            # After a ContractGroup is done, we commit all writes in order to
+            # avoid doing it again in case of an error or a timeout
+            if not test_mode:
+                self.env.cr.commit()    # pylint: disable=invalid-commit
+            logger.info(f"Regenerating invoices for group {count}/{nb_groups}")
+            try:
+                with self.env.cr.savepoint():
+                    res |= group._regenerate_invoices(invoicer)
+            except Exception:
+                self.env.clear()
+                logger.error(
+                    f'contract group {group.id} '
+                    f'failed during invoice regeneration',
+                    exc_info=True)
         return res
 
+    def _regenerate_invoices(self, invoicer):
+        """ Apply the minimal set of operations to bring the invoices of a
+        single group in line with its contracts.
+        :param invoicer: recurring.invoicer used for new invoices
+        :return: invoices that were modified
+        """
+        self.ensure_one()
+        res = kept = self.env['account.invoice']
+        contracts = self.contract_ids.filtered(
+            lambda c: c.state in self._get_gen_states() and
+            c.next_invoice_date)
+        if not contracts:
+            return res
+        start_dates = {
+            c.id: c._get_rewind_date() or c.next_invoice_date
+            for c in contracts
+        }
+        target = self._get_target_invoice_dates(contracts, start_dates)
+        existing = self._get_existing_invoices(contracts, start_dates)
+        journal = self.env['account.journal'].search([
+            ('type', '=', 'sale'),
+            ('company_id', 'in', contracts.mapped('company_id').ids)
+        ], limit=1)
+
+        for invoice_date in sorted(target):
+            date_contracts = target[invoice_date]
+            invoices = existing.pop(
+                invoice_date, self.env['account.invoice'])
+            # Prefer reusing an open invoice rather than a cancelled one
+            invoice = (invoices.filtered(lambda i: i.state == 'open') or
+                       invoices)[:1]
+            # Other invoices at that date are obsolete
+            existing[invoice_date] = invoices - invoice
+            inv_data = self._setup_inv_data(journal, invoicer, date_contracts)
+            inv_data['date_invoice'] = invoice_date
+            if not invoice:
+                invoice = self.env['account.invoice'].create(inv_data)
+            elif invoice.state == 'open' and (
+                    invoice.payment_move_line_ids or not
+                    self._invoice_differs(invoice, contracts, inv_data)):
+                # Invoices already partially paid are left untouched
+                kept |= invoice
+                continue
+            else:
+                if invoice.state == 'open':
+                    invoice.action_invoice_cancel()
+                invoice.action_invoice_draft()
+                invoice.env.clear()
+                invoice.invoice_line_ids.filtered(
+                    lambda line: line.contract_id in contracts).unlink()
+                invoice.write(inv_data)
+            if invoice.invoice_line_ids:
+                invoice.action_invoice_open()
+            else:
+                invoice.unlink()
+                continue
+            res |= invoice
+
+        # Kept invoices are still part of the regenerated set
+        kept.write({'recurring_invoicer_id': invoicer.id})
+
+        # Remove the contract lines from open invoices outside the target
+        obsolete = self.env['account.invoice']
+        for invoices in existing.values():
+            obsolete |= invoices.filtered(
+                lambda i: i.state == 'open' and not i.payment_move_line_ids)
+        if obsolete:
+            res |= contracts._clean_invoice_lines(
+                obsolete.mapped('invoice_line_ids').filtered(
+                    lambda line: line.contract_id in contracts))
+
+        if not self.env.context.get('no_next_date_update'):
+            delta = self.get_relative_delta()
+            for contract in contracts:
+                contract_dates = [d for d, c in target.items() if contract in c]
+                next_date = max(contract_dates) + delta if contract_dates \
+                    else start_dates[contract.id]
+                if next_date != contract.next_invoice_date:
+                    contract.with_context(no_clean_on_write=True).write({
+                        'next_invoice_date': next_date})
+        return res
+
+    def _get_target_invoice_dates(self, contracts, start_dates):
+        """ Compute the invoices that should exist for the group.
+        :param contracts: recurring.contract recordset of the group
+        :param start_dates: dict {contract_id: first date to invoice}
+        :return: dict {invoice_date: recurring.contract recordset}
+        """
+        self.ensure_one()
+        delta = self.get_relative_delta()
+        month_delta = self.advance_billing_months or 1
+        limit_date = date.today() + relativedelta(months=+month_delta)
+        target = dict()
+        for contract in contracts:
+            end_date = contract.end_date and fields.Date.to_date(
+                contract.end_date)
+            current_date = start_dates[contract.id]
+            while current_date <= limit_date and not (
+                    end_date and end_date <= current_date):
+                target.setdefault(current_date, contracts.browse())
+                target[current_date] |= contract
+                current_date += delta
+        return target
+
+    def _get_existing_invoices(self, contracts, start_dates):
+        """ Find the unpaid invoices of the contracts that can be reused for
+        the regeneration.
+        :return: dict {invoice_date: account.invoice recordset}
+        """
+        self.ensure_one()
+        existing = dict()
+        inv_lines = self.env['account.invoice.line'].search([
+            ('contract_id', 'in', contracts.ids),
+            ('state', 'in', ('open', 'cancel')),
+            ('invoice_id.date_invoice', '>=', min(start_dates.values())),
+        ])
+        for inv_line in inv_lines:
+            invoice = inv_line.invoice_id
+            if invoice.date_invoice < start_dates[inv_line.contract_id.id]:
+                continue
+            existing.setdefault(invoice.date_invoice, invoice.browse())
+            existing[invoice.date_invoice] |= invoice
+        return existing
+
+    def _invoice_differs(self, invoice, contracts, inv_data):
+        """ Tells if an open invoice must be rewritten to match the data
+        that would be generated for the group.
+        """
+        fields_to_check = ('partner_id', 'payment_mode_id', 'company_id')
+        if any(invoice[f].id != inv_data[f] for f in fields_to_check):
+            return True
+
+        def line_key(contract_id, product_id, price_unit, quantity):
+            return contract_id, product_id, round(price_unit, 2), quantity
+
+        current_lines = sorted(
+            line_key(line.contract_id.id, line.product_id.id,
+                     line.price_unit, line.quantity)
+            for line in invoice.invoice_line_ids
+            if line.contract_id in contracts
+        )
+        target_lines = sorted(
+            line_key(data['contract_id'], data['product_id'],
+                     data['price_unit'], data['quantity'])
+            for _cmd, _id, data in inv_data['invoice_line_ids']
+        )
+        return current_lines != target_lines
+
+    @api.multi
+    def _update_last_paid_invoice_date(self):
+        """ Compute in SQL the last paid invoice date of the groups from
+        their contracts. """
+        if not self:
+            return True
+        self.env.cr.execute("""
+            UPDATE recurring_contract_group g
+            SET last_paid_invoice_date = t.last_paid
+            FROM (
+                SELECT g.id, MAX(c.last_paid_invoice_date) AS last_paid
+                FROM recurring_contract_group g
+                LEFT JOIN recurring_contract c ON c.group_id = g.id
+                WHERE g.id = ANY(%s)
+                GROUP BY g.id
+            ) t
+            WHERE t.id = g.id
+            AND g.last_paid_invoice_date IS DISTINCT FROM t.last_paid
+        """, [self.ids])
+        self.invalidate_cache(['last_paid_invoice_date'], self.ids)
+        return True
+
     @api.multi
     def _get_change_methods(self):
         """ Method for applying changes """
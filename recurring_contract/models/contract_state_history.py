@@ -0,0 +1,89 @@
+##############################################################################
+#
+#    Copyright (C) 2021 Compassion CH (http://www.compassion.ch)
+#    Releasing children from poverty in Jesus' name
+#
+#    The licence is in the file __manifest__.py
+#
+##############################################################################
+
+from odoo import api, fields, models
+
+
+class ContractStateHistory(models.Model):
+    """ Append-only history of the contract states. Each row tells the
+    period in which a contract had a given state, so that the number of
+    contracts in each state at a given time can be counted without mining
+    the chatter tracking. """
+
+    _name = 'recurring.contract.state.history'
+    _description = 'Contract state history'
+    _order = 'valid_from desc, id desc'
+    _log_access = False
+    _rec_name = 'state'
+
+    contract_id = fields.Many2one(
+        'recurring.contract', 'Contract', required=True, index=True,
+        ondelete='cascade', readonly=True)
+    state = fields.Selection(
+        lambda self: self.env['recurring.contract']._fields[
+            'state'].selection, required=True, readonly=True)
+    valid_from = fields.Datetime(required=True, readonly=True)
+    valid_to = fields.Datetime(readonly=True)
+
+    @api.model_cr
+    def init(self):
+        cr = self.env.cr
+        cr.execute("""
+            CREATE INDEX IF NOT EXISTS recurring_contract_state_history_period
+            ON recurring_contract_state_history
+            USING gist (tsrange(valid_from, valid_to))
+        """)
+        cr.execute("""
+            CREATE INDEX IF NOT EXISTS recurring_contract_state_history_open
+            ON recurring_contract_state_history (contract_id)
+            WHERE valid_to IS NULL
+        """)
+        # Rebuild the history of existing contracts from their dates. The
+        # current state is opened at its date, or at the last modification
+        # of the contract for states without a date column.
+        cr.execute("SELECT 1 FROM recurring_contract_state_history LIMIT 1")
+        if cr.fetchone():
+            return
+        cr.execute("""
+            INSERT INTO recurring_contract_state_history (
+                contract_id, state, valid_from, valid_to)
+            SELECT c.id, s.state, s.valid_from, s.valid_to
+            FROM recurring_contract c,
+            LATERAL (SELECT COALESCE(CASE c.state
+                WHEN 'draft' THEN c.create_date
+                WHEN 'waiting' THEN c.start_date
+                WHEN 'active' THEN c.activation_date
+                WHEN 'terminated' THEN c.end_date
+                WHEN 'cancelled' THEN c.end_date
+            END, c.write_date, c.create_date) AS current_from) d,
+            LATERAL (VALUES
+                ('draft', c.create_date,
+                 COALESCE(c.start_date, c.activation_date, d.current_from)),
+                ('waiting', c.start_date,
+                 COALESCE(c.activation_date, d.current_from)),
+                ('active', c.activation_date, d.current_from),
+                (c.state, d.current_from, NULL)
+            ) AS s(state, valid_from, valid_to)
+            WHERE s.valid_from IS NOT NULL
+            AND (s.valid_to IS NULL OR s.valid_to > s.valid_from)
+        """)
+
+    @api.model
+    def count_by_state(self, at_date=None):
+        """ Count the contracts in each state at a given time.
+        :param at_date: datetime (now by default)
+        :return: dict {state: number of contracts}
+        """
+        self.env.cr.execute("""
+            SELECT state, COUNT(*)
+            FROM recurring_contract_state_history
+            WHERE tsrange(valid_from, valid_to) @> %s::timestamp
+            GROUP BY state
+        """, [at_date or fields.Datetime.now()])
+        return dict(self.env.cr.fetchall())
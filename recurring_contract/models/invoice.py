@@ -10,8 +10,12 @@
 
 from odoo import fields, models, api, _
 from odoo.exceptions import UserError
+from odoo.addons.queue_job.job import identity_exact
 from datetime import date
 import html
+import logging
+
+_logger = logging.getLogger(__name__)
 
 
 class AccountInvoice(models.Model):
@@ -21,47 +25,118 @@ class AccountInvoice(models.Model):
     recurring_invoicer_id = fields.Many2one(
         'recurring.invoicer', 'Invoicer', readonly=False)
 
+    bank_statement_notes_pending = fields.Boolean(
+        copy=False, readonly=True, index=True)
+
     @api.multi
     def register_payment(self, payment_line, writeoff_acc_id=False, writeoff_journal_id=False):
         """After registering a payment post a message of the bank statement linked"""
         out = super().register_payment(payment_line, writeoff_acc_id, writeoff_journal_id)
-        self.message_post_bank_statement_notes()
+        self.defer_bank_statement_notes()
         return out
 
+    @api.multi
+    def defer_bank_statement_notes(self):
+        """Mark the invoices for posting the notes of their bank statements.
+        The notes are posted in one batch job executed after the commit."""
+        if not self:
+            return
+        self.env.cr.execute("""
+            UPDATE account_invoice SET bank_statement_notes_pending = true
+            WHERE id = ANY(%s)
+        """, [self.ids])
+        self.invalidate_cache(['bank_statement_notes_pending'], self.ids)
+        self.browse().with_delay(
+            identity_key=identity_exact)._post_pending_bank_statement_notes()
+
+    @api.model
+    def _post_pending_bank_statement_notes(self):
+        invoices = self.search([('bank_statement_notes_pending', '=', True)])
+        invoices.message_post_bank_statement_notes()
+        self.env.cr.execute("""
+            UPDATE account_invoice SET bank_statement_notes_pending = false
+            WHERE id = ANY(%s)
+        """, [invoices.ids])
+        invoices.invalidate_cache(
+            ['bank_statement_notes_pending'], invoices.ids)
+        return True
+
     @api.multi
     def message_post_bank_statement_notes(self):
         """Post a message in the invoice with the messages
         of the bank statement related to this invoice"""
+        notes = self._get_bank_statement_notes()
         for invoice in self:
-            invoice._message_post_bank_statement_notes()
+            invoice._message_post_bank_statement_notes(notes.get(invoice.id))
 
-    def _message_post_bank_statement_notes(self):
-        notes = self._get_bank_statement_notes()
+    def _message_post_bank_statement_notes(self, notes):
         if not notes:
             return
         notes_text = "".join(f"<li>{html.escape(note)}</li>" for note in notes)
         self.message_post(body=_("Notes from bank statement") + f" : <ul>{notes_text}</ul>")
 
     def _get_bank_statement_notes(self):
-        statement_line_ids = self.mapped("move_id.line_ids.full_reconcile_id.reconciled_line_ids.statement_line_id")
-        return statement_line_ids.filtered("note").mapped("note")
+        """Fetch the notes of the bank statement lines reconciled with the
+        invoices.
+        :return: dict {invoice_id: list of notes}
+        """
+        res = dict()
+        if not self.ids:
+            return res
+        self.env.cr.execute("""
+            SELECT DISTINCT i.id, sl.id, sl.note
+            FROM account_invoice i
+            JOIN account_move_line ml ON ml.move_id = i.move_id
+            JOIN account_move_line rl
+                ON rl.full_reconcile_id = ml.full_reconcile_id
+            JOIN account_bank_statement_line sl ON sl.id = rl.statement_line_id
+            WHERE i.id = ANY(%s) AND COALESCE(sl.note, '') != ''
+            ORDER BY i.id, sl.id
+        """, [self.ids])
+        for invoice_id, _line_id, note in self.env.cr.fetchall():
+            res.setdefault(invoice_id, []).append(note)
+        return res
 
     @api.multi
     def action_invoice_paid(self):
-        """ Call invoice_paid method on related contracts. """
+        """ Call invoices_paid method on related contracts. """
         res = super().action_invoice_paid()
-        for invoice in self:
-            contracts = invoice.mapped('invoice_line_ids.contract_id')
-            contracts.invoice_paid(invoice)
+        invoices_by_contract = self._get_invoices_by_contract()
+        self.env['recurring.contract'].browse(
+            list(invoices_by_contract)).invoices_paid(invoices_by_contract)
         return res
 
     @api.multi
     def action_invoice_re_open(self):
-        """ Call invoice_unpaid method on related contract. """
+        """ Call invoices_unpaid method on related contracts. """
         res = super().action_invoice_re_open()
-        for invoice in self:
-            contracts = invoice.mapped('invoice_line_ids.contract_id')
-            contracts.invoice_unpaid(invoice)
+        invoices_by_contract = self._get_invoices_by_contract()
+        self.env['recurring.contract'].browse(
+            list(invoices_by_contract)).invoices_unpaid(invoices_by_contract)
+        return res
+
+    @api.multi
+    def action_invoice_open(self):
+        res = super().action_invoice_open()
+        self.mapped('invoice_line_ids.contract_id')._update_arrears()
+        return res
+
+    @api.multi
+    def action_invoice_cancel(self):
+        res = super().action_invoice_cancel()
+        self.mapped('invoice_line_ids.contract_id')._update_arrears()
+        return res
+
+    @api.multi
+    def _get_invoices_by_contract(self):
+        """
+        :return: dict {contract_id: account.invoice recordset}
+        """
+        res = dict()
+        for inv_line in self.mapped('invoice_line_ids').filtered(
+                'contract_id'):
+            res.setdefault(inv_line.contract_id.id, self.browse())
+            res[inv_line.contract_id.id] |= inv_line.invoice_id
         return res
 
     @api.multi
@@ -83,41 +158,83 @@ class AccountInvoice(models.Model):
         cancel_invoices.action_invoice_draft()
         cancel_invoices.action_invoice_open()
         today = date.today()
-        for partner_id in self.mapped('partner_id.id'):
-            invoices = self.filtered(lambda i: i.partner_id.id == partner_id)
+
+        # Split invoices in past and future sets for each partner
+        invoice_sets = list()
+        for partner in self.mapped('partner_id'):
+            invoices = self.filtered(lambda i: i.partner_id == partner)
             past_invoices = invoices.filtered(
                 lambda i: i.date_invoice <= today)
-            future_invoices = invoices - past_invoices
-            past_amount = sum(past_invoices.mapped('amount_total'))
-            future_amount = sum(future_invoices.mapped('amount_total'))
-            is_past_reconciled = not past_invoices
-            is_future_reconciled = not future_invoices
-
-            # First try to find matching amount payments
-            open_payments = self.env['account.move.line'].search([
-                ('partner_id', '=', partner_id),
-                ('account_id.code', '=', '1050'),
-                ('reconciled', '=', False),
-                ('credit', 'in', [past_amount, future_amount])
-            ])
-            for payment in open_payments:
-                if not is_past_reconciled and payment.credit == past_amount:
-                    lines = past_invoices.mapped('move_id.line_ids').filtered("debit")
-                    (lines + payment).reconcile()
-                    is_past_reconciled = True
-                elif not is_future_reconciled and payment.credit == future_amount:
-                    lines = future_invoices.mapped('move_id.line_ids').filtered("debit")
-                    (lines + payment).reconcile()
-                    is_future_reconciled = True
-
-            # If no matching payment found, we will group or split.
-            if not is_past_reconciled:
-                past_invoices.with_delay()._group_or_split_reconcile()
-            if not is_future_reconciled:
-                future_invoices.with_delay()._group_or_split_reconcile()
+            for invoice_set in (past_invoices, invoices - past_invoices):
+                if invoice_set:
+                    invoice_sets.append(invoice_set)
+
+        line_obj = self.env['account.move.line']
+        transit_account_ids = self.env['res.company'].get_transit_account_ids()
+        line_obj.lock_for_reconcile([
+            (account_id, partner_id)
+            for account_id in transit_account_ids
+            for partner_id in self.mapped('partner_id').ids
+        ])
+
+        # Fetch at once the payments matching exactly one of the sets
+        amounts = {sum(inv.mapped('amount_total')) for inv in invoice_sets}
+        open_payments = line_obj.search([
+            ('partner_id', 'in', self.mapped('partner_id').ids),
+            ('account_id', 'in', transit_account_ids),
+            ('reconciled', '=', False),
+            ('credit', 'in', list(amounts))
+        ], order='date asc, id asc')
+
+        to_group_or_split = list()
+        for invoice_set in invoice_sets:
+            amount = sum(invoice_set.mapped('amount_total'))
+            payment = open_payments.filtered(
+                lambda p: p.partner_id == invoice_set.partner_id and
+                p.credit == amount)[:1]
+            if payment:
+                open_payments -= payment
+                lines = invoice_set.mapped('move_id.line_ids').filtered(
+                    "debit")
+                (lines + payment).reconcile()
+            else:
+                # If no matching payment found, we will group or split.
+                to_group_or_split.append(invoice_set.ids)
+
+        chunk_size = self.env[
+            'recurring.contract.group']._get_job_chunk_size()
+        for i in range(0, len(to_group_or_split), chunk_size):
+            self.with_delay()._group_or_split_reconcile_batch(
+                to_group_or_split[i:i + chunk_size])
 
         return True
 
+    @api.model
+    def _group_or_split_reconcile_batch(self, invoice_sets):
+        """
+        Reconcile several sets of invoices with open payments. A failure
+        for one set doesn't prevent the other ones to be reconciled: the
+        reason is posted on the invoices of the failing set.
+        :param invoice_sets: list of invoice ids lists
+        :return: list of invoice ids lists that could not be reconciled
+        """
+        failed = list()
+        for invoice_ids in invoice_sets:
+            invoices = self.browse(invoice_ids).exists()
+            try:
+                with self.env.cr.savepoint():
+                    invoices._group_or_split_reconcile()
+            except UserError as error:
+                _logger.error(
+                    f"Invoices {invoice_ids} could not be reconciled",
+                    exc_info=True)
+                failed.append(invoice_ids)
+                for invoice in invoices:
+                    invoice.message_post(
+                        body=_("The invoice could not be reconciled again "
+                               "with the open payments: %s") % error.name)
+        return failed
+
     @api.multi
     def _group_or_split_reconcile(self):
         """
@@ -127,15 +244,24 @@ class AccountInvoice(models.Model):
         partner = self.mapped('partner_id')
         partner.ensure_one()
         reconcile_amount = sum(self.mapped('amount_total'))
+        transit_account_ids = self.env['res.company'].get_transit_account_ids()
+        line_obj = self.env['account.move.line']
+        # Lock before checking the credit, so that no concurrent
+        # reconciliation can use it meanwhile.
+        line_obj.lock_for_reconcile(
+            [(account_id, partner.id) for account_id in transit_account_ids])
+        open_credit = self.env['recurring.partner.credit'].get_open_credit(
+            partner, self.mapped('company_id')[:1])
+        if open_credit < reconcile_amount:
+            raise UserError(_("Cannot reconcile invoices, not enough credit."))
         move_lines = self.mapped('move_id.line_ids').filtered('debit')
         payment_search = [
             ('partner_id', '=', partner.id),
-            ('account_id.code', '=', '1050'),
+            ('account_id', 'in', transit_account_ids),
             ('reconciled', '=', False),
             ('credit', '>', 0)
         ]
 
-        line_obj = self.env['account.move.line']
         payment_greater_than_reconcile = line_obj.search(
             payment_search + [('credit', '>', reconcile_amount)],
             order='date asc', limit=1)
@@ -145,35 +271,15 @@ class AccountInvoice(models.Model):
                 .split_payment_and_reconcile()
         else:
             # Group several payments to match the invoiced amount
-            # Limit to 12 move_lines to avoid too many computations
-            open_payments = line_obj.search(payment_search, limit=12)
+            open_payments = line_obj.search(
+                payment_search, order='date asc, id asc',
+                limit=self._get_reconcile_candidates_limit())
             if sum(open_payments.mapped("credit")) < reconcile_amount:
                 raise UserError(_("Cannot reconcile invoices, not enough credit."))
 
-            # Search for a combination giving the invoiced amount recursively
-            # https://stackoverflow.com/questions/4632322/finding-all-possible-
-            # combinations-of-numbers-to-reach-a-given-sum
-            def find_sum(numbers, target, partial=None):
-                if partial is None:
-                    partial = []
-                s = sum(p.credit for p in partial)
-
-                if s == target:
-                    return partial
-                if s >= target:
-                    return  # if we reach the number why bother to continue
-
-                for i in range(len(numbers)):
-                    ret = find_sum(numbers[i+1:], target,
-                                   partial + [numbers[i]])
-                    if ret is not None:
-                        return ret
-
-            matching_lines = line_obj
-            sum_found = find_sum(open_payments, reconcile_amount)
-            if sum_found is not None:
-                for payment in sum_found:
-                    matching_lines += payment
+            matching_lines = open_payments.find_payment_combination(
+                reconcile_amount)
+            if matching_lines:
                 return (matching_lines | move_lines).reconcile()
             else:
                 # No combination found: we must split one payment
@@ -188,6 +294,13 @@ class AccountInvoice(models.Model):
                     payment_amount += payment_line.credit
                 return (open_payments | move_lines).reconcile()
 
+    @api.model
+    def _get_reconcile_candidates_limit(self):
+        """ Maximum number of open payments considered when searching a
+        combination matching the invoiced amount. """
+        return int(self.env['ir.config_parameter'].sudo().get_param(
+            'recurring_contract.reconcile_candidates_limit', 300)) or 300
+
 
 class AccountInvoiceLine(models.Model):
     _name = 'account.invoice.line'
@@ -204,6 +317,15 @@ class AccountInvoiceLine(models.Model):
         related='invoice_id.state',
         readonly=True, store=True)
 
+    @api.model_cr
+    def init(self):
+        # Used to compute the arrears of contracts
+        self.env.cr.execute("""
+            CREATE INDEX IF NOT EXISTS account_invoice_line_open_due_index
+            ON account_invoice_line (contract_id, due_date)
+            WHERE state = 'open'
+        """)
+
     @api.multi
     def filter_for_contract_rewind(self, filter_state):
         """
@@ -8,6 +8,8 @@
 #
 ##############################################################################
 
+from psycopg2 import sql
+
 from odoo import api, models, exceptions, _
 
 
@@ -20,11 +22,89 @@ class MoveLine(models.Model):
 
     @api.multi
     def reconcile(self, writeoff_acc_id=False, writeoff_journal_id=False):
+        self.lock_for_reconcile([
+            (line.account_id.id, line.partner_id.id)
+            for line in self if line.partner_id
+        ])
         results = super().reconcile(writeoff_acc_id, writeoff_journal_id)
-        for invoice in self.mapped("invoice_id"):
-            invoice.message_post_bank_statement_notes()
+        self.mapped("invoice_id").defer_bank_statement_notes()
+        self.env["recurring.partner.credit"].refresh_open_credit(
+            self.mapped("partner_id").ids)
         return results
 
+    @api.multi
+    def remove_move_reconcile(self):
+        partner_ids = self.mapped("partner_id").ids
+        res = super().remove_move_reconcile()
+        self.env["recurring.partner.credit"].refresh_open_credit(partner_ids)
+        return res
+
+    @api.model
+    def lock_for_reconcile(self, keys):
+        """ Take a PostgreSQL advisory lock for each given account and
+        partner, held until the end of the transaction. Reconciliations of
+        the same partner wait for each other instead of failing with
+        serialization errors, while other partners can be reconciled in
+        parallel. Locks are taken in a stable order to avoid deadlocks.
+        :param keys: list of (account_id, partner_id) tuples
+        :return: True
+        """
+        keys = sorted(set(keys))
+        if keys:
+            self.env.cr.execute("""
+                SELECT pg_advisory_xact_lock(k.account_id, k.partner_id)
+                FROM (
+                    SELECT account_id, partner_id
+                    FROM unnest(%s::int[], %s::int[])
+                        AS t(account_id, partner_id)
+                    ORDER BY account_id, partner_id
+                ) k
+            """, [[k[0] for k in keys], [k[1] for k in keys]])
+        return True
+
+    @api.multi
+    def find_payment_combination(self, amount, column="credit"):
+        """ Find a combination of move lines which sum exactly to the given
+        amount. The computation is done in integer cents with a bounded
+        subset-sum, using python integers as bitsets of the reachable sums.
+        The oldest lines are preferred: the solution is searched in the
+        smallest set of oldest lines and newer lines are discarded first.
+        :param amount: the amount to match
+        :param column: "credit" or "debit"
+        :return: account.move.line recordset (empty if none found)
+        """
+        currency = self.mapped("company_id.currency_id")[:1] or \
+            self.env.user.company_id.currency_id
+        factor = 10 ** currency.decimal_places
+        target = int(round(amount * factor))
+        if target <= 0:
+            return self.browse()
+        lines = self.sorted(lambda l: (l.date, l.id)).filtered(
+            lambda l: 0 < int(round(l[column] * factor)) <= target)
+        mask = (1 << (target + 1)) - 1
+        amounts = list()
+        # reachable[k] holds the sums reachable with the k first lines
+        reachable = [1]
+        for line in lines:
+            cents = int(round(line[column] * factor))
+            amounts.append(cents)
+            reachable.append(
+                (reachable[-1] | (reachable[-1] << cents)) & mask)
+            if reachable[-1] >> target & 1:
+                break
+        else:
+            return self.browse()
+
+        # Walk back from the newest line, only taking it if needed
+        res = self.browse()
+        for k in range(len(amounts), 0, -1):
+            if not target:
+                break
+            if not reachable[k - 1] >> target & 1:
+                res |= lines[k - 1]
+                target -= amounts[k - 1]
+        return res
+
     def split_payment_and_reconcile(self):
         sum_credit = sum(self.mapped("credit"))
         sum_debit = sum(self.mapped("debit"))
@@ -39,7 +119,6 @@ class MoveLine(models.Model):
         for line in self:
             if getattr(line, split_column) > difference:
                 # We will split this line
-                move = line.move_id
                 move_line = line
                 break
         else:
@@ -50,37 +129,52 @@ class MoveLine(models.Model):
                 )
             )
 
-        # Edit move in order to split payment into two move lines
-        payment = move_line.payment_id
-        if payment:
-            payment_lines = payment.move_line_ids
-            payment.move_line_ids = False
-        move.button_cancel()
-        move.write(
-            {
-                "line_ids": [
-                    (1, move_line.id, {split_column: move_line.credit - difference}),
-                    (
-                        0,
-                        0,
-                        {
-                            split_column: difference,
-                            "name": self.env.context.get(
-                                "residual_comment", move_line.name
-                            ),
-                            "account_id": move_line.account_id.id,
-                            "date": move_line.date,
-                            "date_maturity": move_line.date_maturity,
-                            "journal_id": move_line.journal_id.id,
-                            "partner_id": move_line.partner_id.id,
-                        },
-                    ),
-                ]
-            }
-        )
-        move.post()
-        if payment:
-            payment.move_line_ids = payment_lines
+        move_line._split_amount(split_column, difference)
 
         # Perform the reconciliation
         return self.reconcile()
+
+    def _split_amount(self, split_column, amount):
+        """ Isolate an amount of a posted move line into a new move line of
+        the same move. The original line is adjusted in place, without
+        cancelling and posting again the whole move, so that the cost only
+        depends on the split line.
+        :param split_column: "credit" or "debit"
+        :param amount: the amount to put in the new line
+        :return: the new account.move.line
+        """
+        self.ensure_one()
+        if split_column not in ("debit", "credit"):
+            raise exceptions.UserError(
+                _("Only a debit or a credit can be split."))
+        move = self.move_id
+        move._check_lock_date()
+        ratio = amount / self[split_column]
+        amount_currency = self.currency_id.round(
+            self.amount_currency * ratio) if self.currency_id else 0.0
+        # Posted lines can't be modified through the ORM
+        self.env.cr.execute(sql.SQL("""
+            UPDATE account_move_line
+            SET {column} = {column} - %(amount)s,
+                amount_currency = amount_currency - %(amount_currency)s
+            WHERE id = %(id)s
+        """).format(column=sql.Identifier(split_column)), {
+            "amount": amount, "amount_currency": amount_currency,
+            "id": self.id})
+        self.invalidate_cache([split_column, "amount_currency"], self.ids)
+        self.modified([split_column, "amount_currency"])
+        new_line = self.with_context(check_move_validity=False).create({
+            split_column: amount,
+            "name": self.env.context.get("residual_comment", self.name),
+            "move_id": move.id,
+            "account_id": self.account_id.id,
+            "date": self.date,
+            "date_maturity": self.date_maturity,
+            "journal_id": self.journal_id.id,
+            "partner_id": self.partner_id.id,
+            "currency_id": self.currency_id.id,
+            "amount_currency": amount_currency,
+        })
+        self.recompute()
+        move.assert_balanced()
+        return new_line
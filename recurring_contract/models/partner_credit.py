@@ -0,0 +1,95 @@
+##############################################################################
+#
+#    Copyright (C) 2021 Compassion CH (http://www.compassion.ch)
+#    Releasing children from poverty in Jesus' name
+#
+#    The licence is in the file __manifest__.py
+#
+##############################################################################
+
+from odoo import api, fields, models
+
+
+class PartnerCredit(models.Model):
+    """ Open credit of a partner on the payments transit account. The
+    balance is refreshed for the affected partners whenever payments are
+    posted, reconciled or unreconciled, so that checking the available
+    credit of a partner doesn't need to sum its open payments. """
+
+    _name = 'recurring.partner.credit'
+    _description = 'Partner open credit on transit account'
+    _rec_name = 'partner_id'
+
+    partner_id = fields.Many2one(
+        'res.partner', 'Partner', required=True, ondelete='cascade',
+        readonly=True)
+    company_id = fields.Many2one(
+        'res.company', 'Company', required=True, ondelete='cascade',
+        readonly=True)
+    open_credit = fields.Float(readonly=True)
+
+    _sql_constraints = [
+        ('unique_partner_company', 'unique(partner_id, company_id)',
+         'Only one open credit per partner and company!')
+    ]
+
+    @api.model_cr
+    def init(self):
+        # Fill the balances once, when the table was just created by the
+        # installation or the upgrade of the module.
+        self.env.cr.execute("SELECT 1 FROM recurring_partner_credit LIMIT 1")
+        if not self.env.cr.fetchone():
+            self.refresh_open_credit()
+
+    @api.model
+    def refresh_open_credit(self, partner_ids=None):
+        """ Compute again the open credit of the given partners.
+        :param partner_ids: list of res.partner ids (all partners if None)
+        :return: True
+        """
+        if partner_ids is not None and not partner_ids:
+            return True
+        transit_account_ids = self.env[
+            'res.company'].get_transit_account_ids()
+        self.env.cr.execute("""
+            UPDATE recurring_partner_credit
+            SET open_credit = 0
+            WHERE (%(all)s OR partner_id = ANY(%(partner_ids)s))
+            AND open_credit != 0
+        """, {'all': partner_ids is None, 'partner_ids': partner_ids or []})
+        self.env.cr.execute("""
+            INSERT INTO recurring_partner_credit (
+                partner_id, company_id, open_credit, create_uid,
+                create_date, write_uid, write_date)
+            SELECT ml.partner_id, ml.company_id, -SUM(ml.amount_residual),
+                   %(uid)s, now() AT TIME ZONE 'UTC',
+                   %(uid)s, now() AT TIME ZONE 'UTC'
+            FROM account_move_line ml
+            JOIN account_move m ON m.id = ml.move_id
+            WHERE ml.account_id = ANY(%(account_ids)s)
+            AND (%(all)s OR ml.partner_id = ANY(%(partner_ids)s))
+            AND ml.partner_id IS NOT NULL
+            AND NOT ml.reconciled AND ml.credit > 0
+            AND m.state = 'posted'
+            GROUP BY ml.partner_id, ml.company_id
+            ON CONFLICT (partner_id, company_id) DO UPDATE
+            SET open_credit = EXCLUDED.open_credit,
+                write_date = EXCLUDED.write_date
+        """, {
+            'uid': self.env.uid, 'account_ids': list(transit_account_ids),
+            'all': partner_ids is None, 'partner_ids': partner_ids or []
+        })
+        self.invalidate_cache(['open_credit'])
+        return True
+
+    @api.model
+    def get_open_credit(self, partner, company=None):
+        """ Get the open credit of a partner.
+        :param partner: res.partner record
+        :param company: res.company record (all companies if None)
+        :return: float
+        """
+        domain = [('partner_id', '=', partner.id)]
+        if company:
+            domain.append(('company_id', '=', company.id))
+        return sum(self.search(domain).mapped('open_credit'))
@@ -0,0 +1,134 @@
+##############################################################################
+#
+#    Copyright (C) 2021 Compassion CH (http://www.compassion.ch)
+#    Releasing children from poverty in Jesus' name
+#
+#    The licence is in the file __manifest__.py
+#
+##############################################################################
+
+import logging
+
+from odoo import api, fields, models
+from odoo.exceptions import UserError
+
+_logger = logging.getLogger(__name__)
+
+
+class ReconcileRun(models.Model):
+    """ A run of the automatic reconciliation of open payments. It holds
+    the statistics of the run, which are updated by the jobs processing
+    the partners. """
+
+    _name = 'recurring.reconcile.run'
+    _description = 'Automatic reconciliation run'
+    _order = 'start_date desc'
+    _rec_name = 'start_date'
+
+    start_date = fields.Datetime(default=fields.Datetime.now, readonly=True)
+    end_date = fields.Datetime(readonly=True)
+    nb_partners = fields.Integer('Partners', readonly=True)
+    nb_invoices = fields.Integer('Open invoices', readonly=True)
+    nb_reconciled = fields.Integer('Reconciled invoices', readonly=True)
+    match_rate = fields.Float(compute='_compute_statistics')
+    runtime = fields.Float('Runtime (seconds)', compute='_compute_statistics')
+
+    @api.multi
+    def _compute_statistics(self):
+        for run in self:
+            run.match_rate = run.nb_invoices and \
+                run.nb_reconciled * 100.0 / run.nb_invoices
+            run.runtime = run.end_date and (
+                run.end_date - run.start_date).total_seconds()
+
+    @api.model
+    def cron_reconcile_open_payments(self):
+        """ Find all partners having both open payments and open invoices
+        on the transit account and reconcile them in parallel jobs.
+        :return: recurring.reconcile.run record
+        """
+        self.env.cr.execute("""
+            SELECT i.partner_id, COUNT(DISTINCT i.id)
+            FROM account_invoice i
+            WHERE i.state = 'open' AND i.type = 'out_invoice'
+            AND i.account_id = ANY(%s)
+            AND EXISTS (
+                SELECT 1 FROM recurring_partner_credit c
+                WHERE c.partner_id = i.partner_id
+                AND c.company_id = i.company_id
+                AND c.open_credit > 0
+            )
+            GROUP BY i.partner_id
+        """, [self.env['res.company'].get_transit_account_ids()])
+        rows = self.env.cr.fetchall()
+        run = self.create({
+            'nb_partners': len(rows),
+            'nb_invoices': sum(r[1] for r in rows),
+        })
+        partner_ids = [r[0] for r in rows]
+        chunk_size = self.env[
+            'recurring.contract.group']._get_job_chunk_size()
+        for i in range(0, len(partner_ids), chunk_size):
+            run.with_delay()._reconcile_partners(
+                partner_ids[i:i + chunk_size])
+        if not partner_ids:
+            run.end_date = fields.Datetime.now()
+        return run
+
+    @api.multi
+    def _reconcile_partners(self, partner_ids):
+        """ Reconcile the open invoices of the given partners with their
+        open payments, the oldest invoices first. The existing strategies
+        are used: exact amount match, then grouping or splitting payments.
+        :param partner_ids: list of res.partner ids
+        :return: number of reconciled invoices
+        """
+        self.ensure_one()
+        invoice_obj = self.env['account.invoice']
+        line_obj = self.env['account.move.line']
+        nb_reconciled = 0
+        transit_account_ids = self.env['res.company'].get_transit_account_ids()
+        # Take all locks at once, in the stable order avoiding deadlocks
+        line_obj.lock_for_reconcile([
+            (account_id, partner_id)
+            for account_id in transit_account_ids
+            for partner_id in partner_ids
+        ])
+        for partner_id in sorted(partner_ids):
+            invoices = invoice_obj.search([
+                ('partner_id', '=', partner_id),
+                ('type', '=', 'out_invoice'),
+                ('state', '=', 'open'),
+                ('account_id', 'in', transit_account_ids),
+            ], order='date_invoice asc, id asc')
+            for invoice in invoices:
+                payment = line_obj.search([
+                    ('partner_id', '=', partner_id),
+                    ('account_id', '=', invoice.account_id.id),
+                    ('reconciled', '=', False),
+                    ('credit', '=', invoice.amount_total),
+                ], order='date asc, id asc', limit=1)
+                try:
+                    with self.env.cr.savepoint():
+                        if payment:
+                            lines = invoice.move_id.line_ids.filtered(
+                                "debit")
+                            (lines | payment).reconcile()
+                        else:
+                            invoice._group_or_split_reconcile()
+                except UserError:
+                    # No credit left for this partner
+                    break
+                nb_reconciled += 1
+
+        self.env.cr.execute("""
+            UPDATE recurring_reconcile_run
+            SET nb_reconciled = nb_reconciled + %s,
+                end_date = (now() AT TIME ZONE 'UTC')
+            WHERE id = %s
+        """, [nb_reconciled, self.id])
+        self.invalidate_cache(['nb_reconciled', 'end_date'], self.ids)
+        _logger.info(
+            f"Automatic reconciliation: {nb_reconciled} invoices reconciled "
+            f"for {len(partner_ids)} partners.")
+        return nb_reconciled
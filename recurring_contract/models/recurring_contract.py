@@ -8,17 +8,22 @@
 #
 ##############################################################################
 
+import html
 import logging
 
 from datetime import datetime, date
 
+import psycopg2
+
 import odoo.addons.decimal_precision as dp
 from dateutil.relativedelta import relativedelta
 
 from odoo import api, fields, models, _
-from odoo.exceptions import UserError
+from odoo.exceptions import UserError, ValidationError
+from odoo.tools import config
 
 _logger = logging.getLogger(__name__)
+test_mode = config.get('test_enable')
 
 
 class RecurringContract(models.Model):
@@ -51,8 +56,14 @@ class RecurringContract(models.Model):
         readonly=False, states={'draft': [('readonly', False)]},
         default=lambda c: c._default_next_invoice_date(),
         track_visibility="onchange")
-    last_paid_invoice_date = fields.Date(
-        compute='_compute_last_paid_invoice')
+    last_paid_invoice_date = fields.Date(readonly=True, copy=False)
+    months_due = fields.Integer(
+        'Months of arrears', readonly=True, copy=False, index=True,
+        help="Number of distinct months having overdue open invoices.")
+    oldest_open_due_date = fields.Date(readonly=True, copy=False, index=True)
+    open_amount = fields.Float(
+        'Amount in arrears', readonly=True, copy=False,
+        digits=dp.get_precision('Account'))
     partner_id = fields.Many2one(
         'res.partner', 'Partner', required=True, readonly=True,
         states={'draft': [('readonly', False)]}, ondelete='restrict',
@@ -64,6 +75,9 @@ class RecurringContract(models.Model):
     invoice_line_ids = fields.One2many(
         'account.invoice.line', 'contract_id',
         'Related invoice lines', readonly=True, copy=False)
+    state_history_ids = fields.One2many(
+        'recurring.contract.state.history', 'contract_id', 'State history',
+        readonly=True, copy=False)
     contract_line_ids = fields.One2many(
         'recurring.contract.line', 'contract_id',
         'Contract lines', track_visibility="onchange", copy=True, readonly=False)
@@ -92,6 +106,10 @@ class RecurringContract(models.Model):
         default=lambda self: self.env.user.company_id.id, readonly=False
     )
     comment = fields.Text()
+    active = fields.Boolean(
+        default=True, index=True,
+        help="Closed contracts are archived after a retention period, "
+             "so that they are skipped by the daily processing.")
 
     _sql_constraints = [
         ('unique_ref', "unique(reference)", "Reference must be unique!")
@@ -108,18 +126,19 @@ class RecurringContract(models.Model):
                 line.subtotal for line in contract.contract_line_ids
             ])
 
-    def _compute_last_paid_invoice(self):
-        for contract in self:
-            contract.last_paid_invoice_date = max(
-                [invl.invoice_id.date_invoice for invl in
-                 contract.invoice_line_ids if invl.state == 'paid'] or [False])
-
     def _compute_invoices(self):
+        counts = dict()
+        if self.ids:
+            self.env.cr.execute("""
+                SELECT contract_id, COUNT(DISTINCT invoice_id)
+                FROM account_invoice_line
+                WHERE contract_id = ANY(%s)
+                AND state NOT IN ('cancel', 'draft')
+                GROUP BY contract_id
+            """, [self.ids])
+            counts = dict(self.env.cr.fetchall())
         for contract in self:
-            contract.nb_invoices = len(
-                contract.mapped('invoice_line_ids.invoice_id').filtered(
-                    lambda i: i.state not in ('cancel', 'draft')
-                ))
+            contract.nb_invoices = counts.get(contract.id, 0)
 
     @api.model
     def _default_next_invoice_date(self):
@@ -134,14 +153,26 @@ class RecurringContract(models.Model):
     #                              ORM METHODS                               #
     ##########################################################################
 
-    @api.model
-    def create(self, vals):
+    @api.model_cr
+    def init(self):
+        # Groups only iterate over the contracts not archived
+        self.env.cr.execute("""
+            CREATE INDEX IF NOT EXISTS recurring_contract_active_group_index
+            ON recurring_contract (group_id) WHERE active
+        """)
+
+    @api.model_create_multi
+    def create(self, vals_list):
         """ Add a sequence generated ref if none is given """
-        if vals.get('reference', '/') == '/':
-            vals['reference'] = self.env['ir.sequence'].next_by_code(
-                'recurring.contract.ref')
+        missing_refs = [vals for vals in vals_list
+                        if vals.get('reference', '/') == '/']
+        references = self._reserve_references(len(missing_refs))
+        for vals, reference in zip(missing_refs, references):
+            vals['reference'] = reference
 
-        return super().create(vals)
+        contracts = super().create(vals_list)
+        contracts._log_state_history()
+        return contracts
 
     @api.multi
     def write(self, vals):
@@ -150,7 +181,13 @@ class RecurringContract(models.Model):
                 "no_clean_on_write", False):
             self._on_change_next_invoice_date(vals['next_invoice_date'])
 
+        old_groups = self.mapped('group_id') if 'group_id' in vals else None
         res = super().write(vals)
+        if 'state' in vals:
+            self._log_state_history()
+        if old_groups is not None:
+            (old_groups | self.mapped('group_id'))\
+                ._update_last_paid_invoice_date()
 
         clean_is_done = False
         if "partner_id" in vals:
@@ -166,6 +203,25 @@ class RecurringContract(models.Model):
 
         return res
 
+    @api.model
+    def _get_tracked_fields(self, updated_fields):
+        """ The state history can replace the tracking of the state. """
+        tracked_fields = super()._get_tracked_fields(updated_fields)
+        track_state = self.env['ir.config_parameter'].sudo().get_param(
+            'recurring_contract.track_state', 'True')
+        if track_state in ('False', 'false', '0'):
+            tracked_fields.pop('state', None)
+        return tracked_fields
+
+    @api.constrains('active', 'state')
+    def _check_archived_state(self):
+        """ Archived contracts are ignored by their payment option, so only
+        closed contracts can be archived. """
+        if self.filtered(lambda c: not c.active and c.state not in (
+                'terminated', 'cancelled')):
+            raise ValidationError(
+                _("Only terminated or cancelled contracts can be archived."))
+
     @api.multi
     def copy(self, default=None):
         for contract in self:
@@ -199,12 +255,79 @@ class RecurringContract(models.Model):
         """ By default, launch asynchronous job to perform the task.
             Context value async_mode set to False can force to perform
             the task immediately.
+            The task is routed depending on its estimated impact: tiny
+            cleanings are done immediately, medium ones in one job and
+            huge ones are split in several jobs.
         """
-        if self.env.context.get('async_mode', True):
-            self.with_delay()._clean_invoices(
+        if not self.env.context.get('async_mode', True):
+            self._clean_invoices(
+                since_date, to_date, clean_invoices_paid, keep_lines)
+            return
+        impact = self.estimate_clean_impact(
+            since_date, to_date, clean_invoices_paid)
+        params = self.env['ir.config_parameter'].sudo()
+        inline_limit = int(params.get_param(
+            'recurring_contract.clean_inline_limit', 5))
+        job_limit = int(params.get_param(
+            'recurring_contract.clean_job_limit', 500)) or 500
+        if impact['invoices'] <= inline_limit:
+            self._clean_invoices(
                 since_date, to_date, clean_invoices_paid, keep_lines)
         else:
-            self._clean_invoices(since_date, to_date, clean_invoices_paid, keep_lines)
+            nb_jobs = -(-impact['invoices'] // job_limit)
+            size = -(-len(self) // nb_jobs)
+            for i in range(0, len(self), size):
+                self[i:i + size].with_delay()._clean_invoices_job(
+                    since_date, to_date, clean_invoices_paid, keep_lines)
+
+    @api.multi
+    def estimate_clean_impact(self, since_date=None, to_date=None,
+                              clean_invoices_paid=False):
+        """ Cheap estimation of what a call to clean_invoices would touch.
+        :return: dict with number of 'invoices', invoice 'lines' and
+                 'reconciles' that would be cleaned
+        """
+        res = {'invoices': 0, 'lines': 0, 'reconciles': 0}
+        if not self.ids:
+            return res
+        if isinstance(since_date, (date, datetime)):
+            since_date = fields.Date.to_string(since_date)
+        if isinstance(to_date, (date, datetime)):
+            to_date = fields.Date.to_string(to_date)
+        states = ['paid', 'cancel']
+        if clean_invoices_paid:
+            states.remove('paid')
+        # Paid invoices are only cleaned in the future
+        paid_since = since_date or fields.Date.today()
+        self.env.cr.execute("""
+            SELECT COUNT(DISTINCT l.invoice_id), COUNT(l.id),
+                   COUNT(DISTINCT l.invoice_id) FILTER (
+                       WHERE l.state = 'paid')
+            FROM account_invoice_line l
+            WHERE l.contract_id = ANY(%(ids)s)
+            AND l.state NOT IN %(states)s
+            AND (l.state != 'paid' OR l.due_date >= %(paid_since)s)
+            AND (%(since)s IS NULL OR l.due_date >= %(since)s)
+            AND (%(to)s IS NULL OR l.due_date <= %(to)s)
+        """, {
+            'ids': self.ids, 'states': tuple(states), 'since': since_date,
+            'paid_since': paid_since, 'to': to_date
+        })
+        res['invoices'], res['lines'], paid_count = self.env.cr.fetchone()
+        if paid_count:
+            self.env.cr.execute("""
+                SELECT COUNT(DISTINCT ml.full_reconcile_id)
+                FROM account_invoice_line l
+                JOIN account_invoice i ON i.id = l.invoice_id
+                JOIN account_move_line ml ON ml.move_id = i.move_id
+                WHERE l.contract_id = ANY(%(ids)s)
+                AND l.state = 'paid'
+                AND l.due_date >= %(paid_since)s
+                AND (%(to)s IS NULL OR l.due_date <= %(to)s)
+                AND ml.full_reconcile_id IS NOT NULL
+            """, {'ids': self.ids, 'paid_since': paid_since, 'to': to_date})
+            res['reconciles'] = self.env.cr.fetchone()[0]
+        return res
 
     def rewind_next_invoice_date(self):
         """ Rewinds the next invoice date. rewind date will be between today and the
@@ -215,41 +338,12 @@ class RecurringContract(models.Model):
         res = self.env["account.invoice"]
 
         for contract in self:
-            if contract.state not in ["terminated", "cancelled"]:
-                # if paid invoice exist in range next_invoice should be *after*
-                # latest paid invoice
-                latest_paid_invoice_date = max(
-                    contract.invoice_line_ids.filter_for_contract_rewind("paid")
-                    .mapped("invoice_id.date_invoice") or [False]
-                )
-
-                # if there is only open invoice we are looking for the
-                # oldest one (within the range)
-                earliest_open_invoice_date = min(
-                    contract.invoice_line_ids.filter_for_contract_rewind("open")
-                    .mapped("invoice_id.date_invoice") or [False])
-
-                rewind_invoice_date = latest_paid_invoice_date + \
-                    contract.group_id.get_relative_delta() \
-                    if latest_paid_invoice_date else earliest_open_invoice_date
-
-                if rewind_invoice_date:
-                    res |= contract._clean_invoices(rewind_invoice_date)
-                    contract.with_context(no_clean_on_write=True).write({
-                        "next_invoice_date": rewind_invoice_date
-                    })
-                else:
-                    # No open/paid invoices, look for cancelled ones
-                    rewind_invoice_date = min(
-                        contract.invoice_line_ids.filter_for_contract_rewind("cancel")
-                        .mapped("invoice_id.date_invoice") or [False]
-                    )
-
-                    if rewind_invoice_date:
-                        res |= contract._clean_invoices(rewind_invoice_date)
-                        contract.with_context(no_clean_on_write=True).write({
-                            "next_invoice_date": rewind_invoice_date
-                        })
+            rewind_invoice_date = contract._get_rewind_date()
+            if rewind_invoice_date:
+                res |= contract._clean_invoices(rewind_invoice_date)
+                contract.with_context(no_clean_on_write=True).write({
+                    "next_invoice_date": rewind_invoice_date
+                })
 
         return res
 
@@ -283,6 +377,133 @@ class RecurringContract(models.Model):
             res.append(inv_line_data)
         return res
 
+    @api.model
+    def import_contracts(self, rows, chunk_size=None):
+        """
+        Create contracts with their lines and payment options from a stream
+        of rows, each row describing one contract line. Consecutive rows
+        with the same contract reference belong to the same contract, and
+        rows with the same group key share the same payment option.
+        Contracts are created in chunks with multi-record creates. Invalid
+        rows are reported and skipped without aborting the import.
+
+        Recognized keys of the rows:
+            - partner_id or partner_ref
+            - group, payment_mode_id or payment_mode, recurring_value,
+              recurring_unit, advance_billing_months
+            - reference, next_invoice_date
+            - product_id or product_code, amount, quantity
+        :param rows: iterable of dicts
+        :param chunk_size: number of contracts created at once
+        :return: dict {'contract_ids': list of created contract ids,
+                       'errors': list of (row number, message)}
+        """
+        if not chunk_size:
+            chunk_size = self.env[
+                'recurring.contract.group']._get_job_chunk_size()
+        result = {'contract_ids': list(), 'errors': list()}
+        groups = dict()
+        chunk = list()
+        for row_number, row in enumerate(rows, 1):
+            reference = isinstance(row, dict) and row.get('reference')
+            if chunk and reference and chunk[-1][0] == reference:
+                chunk[-1][1].append((row_number, row))
+                continue
+            if len(chunk) >= chunk_size:
+                self._import_contracts_chunk(chunk, groups, result)
+                chunk = list()
+            chunk.append((reference, [(row_number, row)]))
+        if chunk:
+            self._import_contracts_chunk(chunk, groups, result)
+        _logger.info(
+            f"Contract import: {len(result['contract_ids'])} contracts "
+            f"created, {len(result['errors'])} errors.")
+        return result
+
+    @api.model
+    def reassign_partners(self, partner_by_contract):
+        """
+        Move many contracts to new partners at once, for instance when
+        merging duplicate partners. The payment options follow their
+        contracts, and the unpaid invoices from today are given to the new
+        partners instead of being cleaned and generated again.
+        :param partner_by_contract: dict {contract_id: new partner_id}
+        :return: account.invoice recordset moved to the new partners
+        """
+        contracts = self.browse(list(partner_by_contract))
+        partner_by_group = dict()
+        for contract in contracts:
+            partner_id = partner_by_contract[contract.id]
+            group = contract.group_id
+            if partner_by_group.setdefault(group.id, partner_id) != \
+                    partner_id:
+                raise UserError(
+                    _("The contracts of payment option %s must be moved "
+                      "to the same partner.") % group.display_name)
+        other_contracts = self.with_context(
+            active_test=False).search_count([
+                ('group_id', 'in', list(partner_by_group)),
+                ('id', 'not in', contracts.ids),
+            ])
+        if other_contracts:
+            raise UserError(
+                _("All contracts of the payment options must be moved "
+                  "together."))
+
+        partners = contracts.mapped('partner_id') | self.env[
+            'res.partner'].browse(set(partner_by_contract.values()))
+        cr = self.env.cr
+        cr.execute("""
+            UPDATE recurring_contract c
+            SET partner_id = t.partner_id
+            FROM unnest(%s::int[], %s::int[]) AS t(id, partner_id)
+            WHERE c.id = t.id
+        """, [list(partner_by_contract), list(partner_by_contract.values())])
+        cr.execute("""
+            UPDATE recurring_contract_group g
+            SET partner_id = t.partner_id
+            FROM unnest(%s::int[], %s::int[]) AS t(id, partner_id)
+            WHERE g.id = t.id
+        """, [list(partner_by_group), list(partner_by_group.values())])
+
+        # Unpaid future invoices only containing the moved contracts
+        cr.execute("""
+            SELECT i.id, MIN(t.partner_id)
+            FROM account_invoice i
+            JOIN account_invoice_line l ON l.invoice_id = i.id
+            LEFT JOIN unnest(%(ids)s::int[], %(partners)s::int[])
+                AS t(contract_id, partner_id)
+                ON t.contract_id = l.contract_id
+            WHERE i.id IN (
+                SELECT invoice_id FROM account_invoice_line
+                WHERE contract_id = ANY(%(ids)s)
+            )
+            AND i.type = 'out_invoice'
+            AND (i.state = 'draft'
+                 OR i.state = 'open' AND i.residual = i.amount_total)
+            AND i.date_invoice >= CURRENT_DATE
+            GROUP BY i.id
+            HAVING COUNT(*) = COUNT(t.contract_id)
+            AND COUNT(DISTINCT t.partner_id) = 1
+        """, {'ids': list(partner_by_contract),
+              'partners': list(partner_by_contract.values())})
+        partner_by_invoice = dict(cr.fetchall())
+        invoices = self.env['account.invoice'].browse(list(partner_by_invoice))
+        if invoices:
+            self._move_invoices_to_partners(partner_by_invoice)
+
+        self.invalidate_cache(['partner_id'], contracts.ids)
+        self.env['recurring.contract.group'].invalidate_cache(
+            ['partner_id'], list(partner_by_group))
+        contracts.modified(['partner_id'])
+        contracts.mapped('group_id').modified(['partner_id'])
+        self.recompute()
+        self.env['recurring.partner.credit'].refresh_open_credit(
+            (partners | partners.mapped('commercial_partner_id')).ids)
+        contracts._post_digest(
+            _("%s contracts moved to new partners at once.") % len(contracts))
+        return invoices
+
     ##########################################################################
     #                             VIEW CALLBACKS                             #
     ##########################################################################
@@ -309,7 +530,6 @@ class RecurringContract(models.Model):
     @api.multi
     def open_invoices(self):
         self.ensure_one()
-        invoice_ids = self.mapped('invoice_line_ids.invoice_id').ids
         return {
             'name': _('Contract invoices'),
             'type': 'ir.actions.act_window',
@@ -320,7 +540,7 @@ class RecurringContract(models.Model):
                 (self.env.ref('account.invoice_form').id, 'form'),
             ],
             'res_model': 'account.invoice',
-            'domain': [('id', 'in', invoice_ids)],
+            'domain': [('invoice_line_ids.contract_id', '=', self.id)],
             'context': self.with_context(
                 form_view_ref='account.invoice_form',
                 search_default_invoices=True
@@ -344,10 +564,12 @@ class RecurringContract(models.Model):
             raise UserError(_("Active contract cannot be put to waiting"))
         if self.filtered(lambda c: not c.total_amount):
             raise UserError(_("Please configure contract lines"))
-        return self.write({
+        res = self.write({
             'state': 'waiting',
             'start_date': fields.Datetime.now()
         })
+        self.contracts_waiting()
+        return res
 
     @api.multi
     def contract_active(self):
@@ -357,6 +579,7 @@ class RecurringContract(models.Model):
             'state': 'active',
             'activation_date': fields.Datetime.now(),
         })
+        self.contracts_activated()
         return True
 
     @api.multi
@@ -381,7 +604,8 @@ class RecurringContract(models.Model):
             'state': 'terminated',
             'end_date': now
         })
-        self.clean_invoices(now, clean_invoices_paid=True)
+        if not self.env.context.get('batch_terminate'):
+            self.clean_invoices(now, clean_invoices_paid=True)
         return True
 
     @api.multi
@@ -391,7 +615,24 @@ class RecurringContract(models.Model):
             'state': 'cancelled',
             'end_date': today
         })
-        self.clean_invoices(today, clean_invoices_paid=True)
+        if not self.env.context.get('batch_terminate'):
+            self.clean_invoices(today, clean_invoices_paid=True)
+        return True
+
+    @api.multi
+    def mass_terminate(self):
+        """
+        Terminate a large selection of contracts. The contracts are split
+        in jobs by payment options and each job cleans and reconciles again
+        the invoices once per partner.
+        :return: True
+        """
+        async_mode = self.env.context.get('async_mode', True)
+        for contracts in self._split_in_group_chunks():
+            if async_mode:
+                contracts.with_delay()._terminate_by_partner_job()
+            else:
+                contracts._terminate_by_partner()
         return True
 
     @api.multi
@@ -402,6 +643,7 @@ class RecurringContract(models.Model):
                               "draft."))
         self.write({
             'state': 'draft',
+            'active': True,
             'end_date': False,
             'activation_date': False,
             'next_invoice_date': self._default_next_invoice_date(),
@@ -417,6 +659,78 @@ class RecurringContract(models.Model):
         self.contract_active()
         return True
 
+    @api.multi
+    def bulk_transition(self, state):
+        """
+        Set-based version of contract_waiting and force_activation for large
+        selections of contracts. The preconditions are checked at once for
+        all contracts, then the contracts are transitioned by chunks (in
+        jobs unless async_mode is False). Instead of tracking the state of
+        each contract, one digest message is posted per chunk.
+        The transition is done in SQL: overrides of contract_waiting and
+        contract_active are not called, only the contracts_waiting and
+        contracts_activated hooks.
+        :param state: 'waiting' or 'active'
+        :return: True
+        """
+        self._check_bulk_transition(state)
+        group_obj = self.env['recurring.contract.group']
+        size = group_obj._get_job_chunk_size()
+        async_mode = self.env.context.get('async_mode', True)
+        for i in range(0, len(self), size):
+            contracts = self[i:i + size]
+            if async_mode:
+                contracts.with_delay()._bulk_transition(state)
+            else:
+                contracts._bulk_transition(state)
+        return True
+
+    @api.multi
+    def contracts_waiting(self):
+        """ Hook called once for all contracts put in waiting state, either
+        by contract_waiting or by bulk_transition. Override this method
+        rather than contract_waiting to process the validated contracts,
+        as bulk_transition doesn't go through the ORM transition. """
+        return True
+
+    @api.multi
+    def contracts_activated(self):
+        """ Hook called once for all contracts activated, either by
+        contract_active or by bulk_transition. Override this method
+        rather than contract_active to process the activated contracts,
+        as bulk_transition doesn't go through the ORM transition. """
+        return True
+
+    @api.multi
+    def invoices_unpaid(self, invoices_by_contract):
+        """ Hook when invoices are unpaid, called once for all contracts.
+        :param invoices_by_contract: dict {contract_id: account.invoice}
+        """
+        self._update_last_paid_invoice_date()
+        self._update_arrears()
+        for invoice, contracts in self._group_by_invoice(
+                invoices_by_contract):
+            contracts.invoice_unpaid(invoice)
+
+    @api.multi
+    def invoices_paid(self, invoices_by_contract):
+        """ Hook when invoices are paid, called once for all contracts.
+        Override this method for set-based processing of paid invoices.
+        The hooks are called in this order:
+            1. contracts waiting for payment are activated at once,
+            2. invoice_paid is called for each invoice with its contracts,
+               which are therefore already active.
+        :param invoices_by_contract: dict {contract_id: account.invoice}
+        """
+        self._update_last_paid_invoice_date()
+        self._update_arrears()
+        activate_contracts = self.filtered(lambda c: c.state == 'waiting')
+        if activate_contracts:
+            activate_contracts.contract_active()
+        for invoice, contracts in self._group_by_invoice(
+                invoices_by_contract):
+            contracts.invoice_paid(invoice)
+
     @api.multi
     def invoice_unpaid(self, invoice):
         """ Hook when invoice is unpaid """
@@ -424,19 +738,62 @@ class RecurringContract(models.Model):
 
     @api.multi
     def invoice_paid(self, invoice):
-        """ Activate contract if it is waiting for payment. """
+        """ Activate contract if it is waiting for payment. When called by
+        invoices_paid, the contracts were already activated at once. """
         activate_contracts = self.filtered(lambda c: c.state == 'waiting')
         if activate_contracts:
             activate_contracts.contract_active()
 
+    @api.model
+    def cron_update_arrears(self):
+        """ Invoices become overdue with time: refresh the arrears of the
+        contracts having overdue open invoices or arrears already stored.
+        """
+        self.env.cr.execute("""
+            SELECT contract_id FROM account_invoice_line
+            WHERE state = 'open' AND due_date < CURRENT_DATE
+            AND contract_id IS NOT NULL
+            UNION
+            SELECT id FROM recurring_contract WHERE months_due > 0
+        """)
+        contract_ids = [r[0] for r in self.env.cr.fetchall()]
+        self.browse(contract_ids)._update_arrears()
+        return True
+
+    @api.model
+    def cron_archive_closed_contracts(self):
+        """ Archive the terminated and cancelled contracts ended for longer
+        than the retention period and having no open invoice.
+        :return: recurring.contract recordset archived
+        """
+        retention_days = int(self.env['ir.config_parameter'].sudo().get_param(
+            'recurring_contract.archive_retention_days', 730))
+        self.env.cr.execute("""
+            UPDATE recurring_contract c
+            SET active = false
+            WHERE c.active
+            AND c.state IN ('terminated', 'cancelled')
+            AND c.end_date < (now() AT TIME ZONE 'UTC') - %s * interval '1 day'
+            AND NOT EXISTS (
+                SELECT 1 FROM account_invoice_line l
+                WHERE l.contract_id = c.id AND l.state IN ('draft', 'open')
+            )
+            RETURNING c.id
+        """, [retention_days])
+        archived = self.browse([row[0] for row in self.env.cr.fetchall()])
+        archived.invalidate_cache(['active'], archived.ids)
+        archived.modified(['active'])
+        _logger.info(f"{len(archived)} closed contracts archived.")
+        return archived
+
     @api.model
     def end_date_reached(self):
         now = fields.Datetime.now()
         expired = self.search([
-            ('end_date', '>=', now),
+            ('end_date', '<=', now),
             ('state', 'not in', ['cancelled', 'terminated'])
         ])
-        return expired.action_contract_terminate()
+        return expired.mass_terminate()
 
     def clean_invoices_paid(self, since_date, to_date):
         """
@@ -486,13 +843,82 @@ class RecurringContract(models.Model):
         :return: invoices cleaned (which should be in cancel state)
         """
         _logger.info("clean invoices called.")
+        # Only the job entry point commits the windows: nested cleanings
+        # must not commit the transaction of their caller.
+        commit_windows = self.env.context.get('commit_windows') and \
+            not test_mode
+        if commit_windows:
+            self = self.with_context(commit_windows=False)
         if isinstance(since_date, (date, datetime)):
             since_date = fields.Date.to_string(since_date)
         if isinstance(to_date, (date, datetime)):
             to_date = fields.Date.to_string(to_date)
+        invoices = self.env['account.invoice']
+        paid_invoices = invoices
         if clean_invoices_paid:
             paid_invoices = self.clean_invoices_paid(since_date, to_date)
         inv_lines = self._get_invoice_lines_to_clean(since_date, to_date)
+        windows = self._get_clean_windows(inv_lines) or [inv_lines]
+        # Paid invoices are reconciled again with the window cleaning them,
+        # the ones outside of all windows with the first window.
+        window_invoices = [lines.mapped('invoice_id') for lines in windows]
+        paid_by_window = [paid_invoices & inv for inv in window_invoices]
+        paid_by_window[0] |= paid_invoices - sum(window_invoices, invoices)
+        for index, window_lines in enumerate(windows, start=1):
+            _logger.info(f"Cleaning invoices window {index}/{len(windows)}")
+            invoices |= self._clean_invoice_lines(window_lines, keep_lines)
+            # Finish the work of the window before committing it, because
+            # a retry of the job won't find the windows already committed.
+            if paid_by_window[index - 1]:
+                paid_by_window[index - 1].reconcile_after_clean()
+            # Commit each window inside jobs, so that a long history
+            # doesn't need to be processed again after a timeout.
+            if len(windows) > 1 and commit_windows:
+                self.env.cr.commit()  # pylint: disable=invalid-commit
+
+        _logger.info(str(len(invoices)) + " invoices cleaned.")
+        return invoices
+
+    @api.multi
+    def _clean_invoices_job(self, since_date=None, to_date=None,
+                            clean_invoices_paid=False, keep_lines=False):
+        """ Job cleaning the invoices, committing each window of invoices.
+        :return: invoices cleaned
+        """
+        return self.with_context(commit_windows=True)._clean_invoices(
+            since_date, to_date, clean_invoices_paid, keep_lines)
+
+    def _get_clean_windows(self, inv_lines):
+        """ Split the invoice lines to clean in windows of a bounded number
+        of invoices, ordered by invoice date. The size of the windows is
+        given by the system parameter recurring_contract.clean_window_size.
+        :return: list of account.invoice.line recordsets
+        """
+        size = int(self.env['ir.config_parameter'].sudo().get_param(
+            'recurring_contract.clean_window_size', 200)) or 200
+        invoices = inv_lines.mapped('invoice_id').sorted(
+            lambda i: (i.date_invoice, i.id))
+        lines_by_invoice = dict()
+        for inv_line in inv_lines:
+            lines_by_invoice.setdefault(
+                inv_line.invoice_id.id, inv_lines.browse())
+            lines_by_invoice[inv_line.invoice_id.id] |= inv_line
+        windows = list()
+        for i in range(0, len(invoices), size):
+            window_lines = inv_lines.browse()
+            for invoice in invoices[i:i + size]:
+                window_lines |= lines_by_invoice[invoice.id]
+            windows.append(window_lines)
+        return windows
+
+    def _clean_invoice_lines(self, inv_lines, keep_lines=False):
+        """ Remove the given invoice lines of the contracts from their
+        invoices. Invoices that would be empty are cancelled, the other
+        ones are validated again.
+        :param inv_lines: account.invoice.line recordset to clean
+        :param keep_lines: set to true to avoid deleting invoice lines
+        :return: invoices cleaned
+        """
         invoices = inv_lines.mapped('invoice_id')
         empty_invoices = self.env['account.invoice']
         to_remove_invl = self.env['account.invoice.line']
@@ -521,11 +947,6 @@ class RecurringContract(models.Model):
         self.env.clear()
         renew_invs.action_invoice_open()
         self.env.clear()
-
-        if clean_invoices_paid:
-            paid_invoices.reconcile_after_clean()
-
-        _logger.info(str(len(invoices)) + " invoices cleaned.")
         return invoices
 
     def _on_contract_lines_changed(self):
@@ -545,6 +966,161 @@ class RecurringContract(models.Model):
         if self._update_invoice_lines(invoices):
             invoices.action_invoice_open()
 
+    def _get_rewind_date(self):
+        """ Find the date from which the invoices of a single contract can
+        be regenerated: after the latest paid invoice if any, otherwise the
+        earliest open (or cancelled) invoice.
+        :return: date or False if the contract doesn't need a rewind
+        """
+        self.ensure_one()
+        if self.state in ["terminated", "cancelled"]:
+            return False
+        # if paid invoice exist in range next_invoice should be *after*
+        # latest paid invoice
+        latest_paid_invoice_date = max(
+            self.invoice_line_ids.filter_for_contract_rewind("paid")
+            .mapped("invoice_id.date_invoice") or [False]
+        )
+        if latest_paid_invoice_date:
+            return latest_paid_invoice_date + \
+                self.group_id.get_relative_delta()
+
+        # if there is only open invoice we are looking for the
+        # oldest one (within the range), otherwise for cancelled ones
+        return min(
+            self.invoice_line_ids.filter_for_contract_rewind("open")
+            .mapped("invoice_id.date_invoice") or [False]
+        ) or min(
+            self.invoice_line_ids.filter_for_contract_rewind("cancel")
+            .mapped("invoice_id.date_invoice") or [False]
+        )
+
+    def _amend_invoices_price(self, product, old_price, new_price,
+                              effective_date):
+        """ Update the price of the open invoice lines of the contracts
+        selling the given product. Each invoice is updated only once,
+        whatever the number of contracts it contains. Invoices having
+        payments can't be cancelled and are left untouched.
+        """
+        # Only the job entry point commits the windows: nested calls
+        # must not commit the transaction of their caller.
+        commit_windows = self.env.context.get('commit_windows') and \
+            not test_mode
+        if commit_windows:
+            self = self.with_context(commit_windows=False)
+        lock_date = self.mapped("company_id")[:1].period_lock_date
+        if lock_date and lock_date >= fields.Date.to_date(effective_date):
+            effective_date = lock_date + relativedelta(days=1)
+        inv_lines = self.env['account.invoice.line'].search([
+            ('contract_id', 'in', self.ids),
+            ('product_id', '=', product.id),
+            ('price_unit', '=', old_price),
+            ('state', '=', 'open'),
+            ('due_date', '>=', fields.Date.to_string(effective_date)),
+        ])
+        invoices = inv_lines.mapped('invoice_id')
+        paid_invoices = invoices.filtered('payment_move_line_ids')
+        if paid_invoices:
+            _logger.warning(
+                "Invoices %s are partially paid and keep their old price.",
+                paid_invoices.ids)
+            invoices -= paid_invoices
+            inv_lines = inv_lines.filtered(lambda l: l.invoice_id in invoices)
+        window = int(self.env['ir.config_parameter'].sudo().get_param(
+            'recurring_contract.clean_window_size', 200)) or 200
+        for i in range(0, len(invoices), window):
+            window_invoices = invoices[i:i + window]
+            window_lines = inv_lines.filtered(
+                lambda l: l.invoice_id in window_invoices)
+            window_invoices.action_invoice_cancel()
+            window_invoices.action_invoice_draft()
+            window_invoices.invalidate_cache(ids=window_invoices.ids)
+            window_lines.invalidate_cache(ids=window_lines.ids)
+            window_lines.write({'price_unit': new_price})
+            window_invoices.action_invoice_open()
+            if commit_windows:
+                self.env.cr.commit()  # pylint: disable=invalid-commit
+        return invoices
+
+    @api.multi
+    def _update_last_paid_invoice_date(self):
+        """ Compute in SQL the last paid invoice date of the contracts and
+        of their groups. Called with all contracts to backfill the values.
+        """
+        if not self:
+            return True
+        self.env.cr.execute("""
+            UPDATE recurring_contract c
+            SET last_paid_invoice_date = t.last_paid
+            FROM (
+                SELECT c.id, MAX(i.date_invoice) AS last_paid
+                FROM recurring_contract c
+                LEFT JOIN account_invoice_line l ON l.contract_id = c.id
+                LEFT JOIN account_invoice i
+                    ON i.id = l.invoice_id AND i.state = 'paid'
+                WHERE c.id = ANY(%s)
+                GROUP BY c.id
+            ) t
+            WHERE t.id = c.id
+            AND c.last_paid_invoice_date IS DISTINCT FROM t.last_paid
+        """, [self.ids])
+        self.invalidate_cache(['last_paid_invoice_date'], self.ids)
+        self.mapped('group_id')._update_last_paid_invoice_date()
+        return True
+
+    @api.multi
+    def _update_arrears(self):
+        """ Compute in SQL the arrears of the contracts: the number of
+        distinct months having overdue open invoices, the oldest open due
+        date and the overdue open amount.
+        """
+        if not self:
+            return True
+        self.env.cr.execute("""
+            UPDATE recurring_contract c
+            SET months_due = COALESCE(t.months_due, 0),
+                oldest_open_due_date = t.oldest_due_date,
+                open_amount = COALESCE(t.open_amount, 0)
+            FROM (
+                SELECT c.id,
+                    MAX(d.month_rank) AS months_due,
+                    MIN(d.due_date) AS oldest_due_date,
+                    SUM(d.price_subtotal) AS open_amount
+                FROM recurring_contract c
+                LEFT JOIN (
+                    SELECT l.contract_id, l.due_date, l.price_subtotal,
+                        dense_rank() OVER (
+                            PARTITION BY l.contract_id
+                            ORDER BY date_trunc('month', l.due_date)
+                        ) AS month_rank
+                    FROM account_invoice_line l
+                    WHERE l.contract_id = ANY(%(ids)s)
+                    AND l.state = 'open' AND l.due_date < CURRENT_DATE
+                ) d ON d.contract_id = c.id
+                WHERE c.id = ANY(%(ids)s)
+                GROUP BY c.id
+            ) t
+            WHERE t.id = c.id
+            AND (c.months_due IS DISTINCT FROM COALESCE(t.months_due, 0)
+                 OR c.oldest_open_due_date IS DISTINCT FROM t.oldest_due_date
+                 OR c.open_amount IS DISTINCT FROM COALESCE(t.open_amount, 0))
+        """, {'ids': self.ids})
+        self.invalidate_cache(
+            ['months_due', 'oldest_open_due_date', 'open_amount'], self.ids)
+        return True
+
+    def _group_by_invoice(self, invoices_by_contract):
+        """ Invert the mapping of invoices by contract, in order to call
+        the hooks that are defined for one invoice.
+        :return: list of (account.invoice, recurring.contract) tuples
+        """
+        contracts_by_invoice = dict()
+        for contract in self:
+            for invoice in invoices_by_contract.get(contract.id, []):
+                contracts_by_invoice.setdefault(invoice, self.browse())
+                contracts_by_invoice[invoice] |= contract
+        return list(contracts_by_invoice.items())
+
     def _compute_next_invoice_date(self):
         """ Compute next_invoice_date for a single contract. """
         next_date = self.next_invoice_date
@@ -616,3 +1192,556 @@ class RecurringContract(models.Model):
         if to_date:
             invl_search.append(('due_date', '<=', to_date))
         return invl_search
+
+    @api.model
+    def _reserve_references(self, count):
+        """ Take a block of contract references from the sequence at once.
+        :param count: number of references to reserve
+        :return: list of references
+        """
+        if not count:
+            return list()
+        seq_obj = self.env['ir.sequence']
+        company_id = self.env.context.get('force_company') or \
+            self.env.user.company_id.id
+        sequence = seq_obj.sudo().search([
+            ('code', '=', 'recurring.contract.ref'),
+            ('company_id', 'in', [company_id, False])
+        ], order='company_id', limit=1)
+        if not sequence or sequence.use_date_range:
+            return [seq_obj.next_by_code('recurring.contract.ref')
+                    for i in range(count)]
+        if sequence.implementation == 'standard':
+            self.env.cr.execute(
+                "SELECT nextval(%s) FROM generate_series(1, %s)",
+                ['ir_sequence_%03d' % sequence.id, count])
+            numbers = [row[0] for row in self.env.cr.fetchall()]
+        else:
+            self.env.cr.execute("""
+                UPDATE ir_sequence
+                SET number_next = number_next + %s * number_increment
+                WHERE id = %s
+                RETURNING number_next, number_increment
+            """, [count, sequence.id])
+            number_next, increment = self.env.cr.fetchone()
+            numbers = [number_next - (count - i) * increment
+                       for i in range(count)]
+            sequence.invalidate_cache(['number_next'], sequence.ids)
+        return [sequence.get_next_char(number) for number in numbers]
+
+    @api.model
+    def _import_contracts_chunk(self, chunk, groups, result):
+        """ Create the contracts of a chunk of imported rows.
+        :param chunk: list of (reference, list of (row number, row))
+        :param groups: dict {group key: contract group id} of the groups
+                       already created by the import
+        :param result: dict updated with created contracts and errors
+        :return: None
+        """
+        rows = [row for reference, contract_rows in chunk
+                for row_number, row in contract_rows
+                if isinstance(row, dict)]
+        lookups = {
+            'partner_ref': self._import_lookup(
+                'res.partner', 'ref', rows, 'partner_ref'),
+            'product_code': self._import_lookup(
+                'product.product', 'default_code', rows, 'product_code'),
+            'payment_mode': self._import_lookup(
+                'account.payment.mode', 'name', rows, 'payment_mode'),
+        }
+        items = list()
+        for reference, contract_rows in chunk:
+            item = {'rows': [row_number for row_number, row in contract_rows],
+                    'lines': list()}
+            errors = list()
+            for row_number, row in contract_rows:
+                try:
+                    if not isinstance(row, dict):
+                        raise ValueError(_("Invalid row"))
+                    if not item['lines']:
+                        item.update(self._import_parse_contract(
+                            row, row_number, lookups))
+                    item['lines'].append(
+                        self._import_parse_line(row, lookups))
+                except ValueError as error:
+                    errors.append((row_number, str(error)))
+            if errors:
+                result['errors'].extend(errors)
+            else:
+                items.append(item)
+
+        try:
+            with self.env.cr.savepoint():
+                contracts = self._import_create(items, groups)
+            result['contract_ids'].extend(contracts.ids)
+        except (UserError, ValidationError, psycopg2.Error):
+            # Isolate the failing contracts
+            self.env.clear()
+            for item in items:
+                try:
+                    with self.env.cr.savepoint():
+                        contracts = self._import_create([item], groups)
+                    result['contract_ids'].extend(contracts.ids)
+                except (UserError, ValidationError, psycopg2.Error) as error:
+                    self.env.clear()
+                    message = getattr(error, 'name', False) or str(error)
+                    result['errors'].extend(
+                        (row_number, message) for row_number in item['rows'])
+
+    @api.model
+    def _import_split_chunks(self, rows, chunk_size):
+        """ Split imported rows in chunks of contracts imported by separate
+        jobs. The contracts of a same group are kept in the same chunk, so
+        that their payment option is created only once.
+        :param rows: iterable of dicts
+        :param chunk_size: number of contracts of a chunk (a bigger group
+                           is not split)
+        :return: list of chunks given to _import_contracts_chunk
+        """
+        contracts_by_group = dict()
+        contract = None
+        for row_number, row in enumerate(rows, 1):
+            reference = isinstance(row, dict) and row.get('reference')
+            if contract and reference and contract[0] == reference:
+                contract[1].append((row_number, row))
+                continue
+            contract = (reference, [(row_number, row)])
+            group_key = isinstance(row, dict) and row.get('group') or \
+                ('row', row_number)
+            contracts_by_group.setdefault(group_key, list()).append(contract)
+        chunks = [list()]
+        for contracts in contracts_by_group.values():
+            if chunks[-1] and len(chunks[-1]) + len(contracts) > chunk_size:
+                chunks.append(list())
+            chunks[-1].extend(contracts)
+        return [chunk for chunk in chunks if chunk]
+
+    @api.model
+    def _import_contracts_job(self, chunk, wizard_id=None):
+        """ Job importing a chunk of contracts. The result is reported on
+        the import wizard, as long as it is not removed by the vacuum.
+        :param chunk: list of (reference, list of (row number, row))
+        :param wizard_id: recurring.contract.import.wizard id
+        :return: dict {'contract_ids': list of created contract ids,
+                       'errors': list of (row number, message)}
+        """
+        result = {'contract_ids': list(), 'errors': list()}
+        self._import_contracts_chunk(chunk, dict(), result)
+        if wizard_id:
+            wizard_obj = self.env['recurring.contract.import.wizard']
+            self.env.cr.execute("""
+                UPDATE recurring_contract_import_wizard
+                SET nb_imported = nb_imported + %(imported)s,
+                    nb_processed = nb_processed + %(processed)s,
+                    error_log = CONCAT_WS(E'\\n', NULLIF(error_log, ''),
+                                          NULLIF(%(errors)s, '')),
+                    state = CASE
+                        WHEN nb_processed + %(processed)s >= nb_contracts
+                        THEN 'done' ELSE state END,
+                    write_date = (now() AT TIME ZONE 'UTC')
+                WHERE id = %(id)s
+            """, {
+                'imported': len(result['contract_ids']),
+                'processed': len(chunk),
+                'errors': wizard_obj._format_errors(result['errors']),
+                'id': wizard_id,
+            })
+            wizard_obj.browse(wizard_id).invalidate_cache([
+                'nb_imported', 'nb_processed', 'error_log', 'state'])
+        return result
+
+    @api.model
+    def _import_create(self, items, groups):
+        """ Create the groups, contracts and contract lines of parsed
+        imported rows, with one create for each model.
+        :param items: list of dicts with keys group_key, group, contract,
+                      lines
+        :param groups: dict {group key: contract group id}, updated with
+                       the created groups
+        :return: recurring.contract recordset created
+        """
+        new_groups = dict()
+        for item in items:
+            if item['group_key'] not in groups:
+                new_groups.setdefault(item['group_key'], item['group'])
+        created_groups = self.env['recurring.contract.group'].create(
+            list(new_groups.values()))
+        group_ids = dict(groups)
+        group_ids.update(zip(new_groups, created_groups.ids))
+        contracts = self.create([
+            dict(item['contract'], group_id=group_ids[item['group_key']])
+            for item in items
+        ])
+        self.env['recurring.contract.line'].create([
+            dict(line_vals, contract_id=contract.id)
+            for item, contract in zip(items, contracts)
+            for line_vals in item['lines']
+        ])
+        groups.update(group_ids)
+        return contracts
+
+    @api.model
+    def _import_lookup(self, model, field, rows, column):
+        """ Find at once the records referenced by a column of the rows.
+        :return: dict {value: record id}
+        """
+        values = list({row[column] for row in rows if row.get(column)})
+        if not values:
+            return dict()
+        records = self.env[model].search([(field, 'in', values)])
+        return {record[field]: record.id for record in records}
+
+    @api.model
+    def _import_get_id(self, row, id_column, key_column, lookups):
+        if row.get(id_column):
+            return int(row[id_column])
+        record_id = lookups[key_column].get(row.get(key_column))
+        if not record_id:
+            raise ValueError(
+                _("Unknown %s '%s'") % (key_column, row.get(key_column, '')))
+        return record_id
+
+    @api.model
+    def _import_parse_contract(self, row, row_number, lookups):
+        """ Read the contract and group values of an imported row.
+        Raise ValueError if they are invalid.
+        :return: dict {'group_key', 'group', 'contract'}
+        """
+        partner_id = self._import_get_id(
+            row, 'partner_id', 'partner_ref', lookups)
+        recurring_unit = row.get('recurring_unit') or 'month'
+        if recurring_unit not in ('day', 'week', 'month', 'year'):
+            raise ValueError(
+                _("Invalid recurring unit '%s'") % recurring_unit)
+        group_vals = {
+            'partner_id': partner_id,
+            'recurring_unit': recurring_unit,
+            'recurring_value': int(row.get('recurring_value') or 1),
+            'advance_billing_months': int(
+                row.get('advance_billing_months') or 1),
+        }
+        if row.get('payment_mode_id') or row.get('payment_mode'):
+            group_vals['payment_mode_id'] = self._import_get_id(
+                row, 'payment_mode_id', 'payment_mode', lookups)
+        contract_vals = {
+            'partner_id': partner_id,
+            'reference': row.get('reference') or '/',
+        }
+        if row.get('next_invoice_date'):
+            contract_vals['next_invoice_date'] = fields.Date.to_date(
+                row['next_invoice_date'])
+        return {
+            'group_key': row.get('group') or ('row', row_number),
+            'group': group_vals,
+            'contract': contract_vals,
+        }
+
+    @api.model
+    def _import_parse_line(self, row, lookups):
+        """ Read the contract line values of an imported row.
+        Raise ValueError if they are invalid.
+        :return: dict of recurring.contract.line values
+        """
+        return {
+            'product_id': self._import_get_id(
+                row, 'product_id', 'product_code', lookups),
+            'amount': float(row.get('amount') or 0.0),
+            'quantity': int(row.get('quantity') or 1),
+        }
+
+    @api.multi
+    def _check_bulk_transition(self, state):
+        """ Check in SQL that all contracts can be put in the given state.
+        :param state: 'waiting' or 'active'
+        :return: None
+        """
+        if state not in ('waiting', 'active'):
+            raise ValueError(f"Invalid contract state {state}")
+        self.env.cr.execute("""
+            SELECT reference FROM recurring_contract
+            WHERE id = ANY(%s)
+            AND (state NOT IN %s
+                 OR state = 'draft' AND COALESCE(total_amount, 0) = 0)
+            ORDER BY reference
+            LIMIT 10
+        """, [self.ids, ('draft', 'waiting') if state == 'active'
+              else ('draft',)])
+        references = [row[0] for row in self.env.cr.fetchall()]
+        if references:
+            raise UserError(
+                _("The following contracts cannot be put in state %s, "
+                  "please check their state and contract lines: %s")
+                % (state, ", ".join(references)))
+
+    @api.multi
+    def _bulk_transition(self, state):
+        """ Transition a chunk of contracts in SQL, then call the batch hooks
+        and post one digest message for the chunk.
+        :param state: 'waiting' or 'active'
+        :return: True
+        """
+        now = fields.Datetime.now()
+        params = {'ids': self.ids, 'now': now, 'uid': self.env.uid}
+        self.env.cr.execute("""
+            UPDATE recurring_contract
+            SET state = 'waiting', start_date = %(now)s,
+                write_date = %(now)s, write_uid = %(uid)s
+            WHERE id = ANY(%(ids)s) AND state = 'draft'
+            RETURNING id
+        """, params)
+        waiting = self.browse([row[0] for row in self.env.cr.fetchall()])
+        activated = self.browse()
+        if state == 'active':
+            self.env.cr.execute("""
+                UPDATE recurring_contract
+                SET state = 'active', activation_date = %(now)s,
+                    write_date = %(now)s, write_uid = %(uid)s
+                WHERE id = ANY(%(ids)s) AND state = 'waiting'
+                RETURNING id
+            """, params)
+            activated = self.browse([row[0] for row in self.env.cr.fetchall()])
+        fnames = ['state', 'start_date', 'activation_date', 'write_date',
+                  'write_uid']
+        self.invalidate_cache(fnames, self.ids)
+        (waiting | activated)._log_state_history(now)
+        self.modified(fnames)
+        self.recompute()
+
+        if waiting:
+            waiting.contracts_waiting()
+            waiting._post_digest(
+                _("%s contracts validated at once.") % len(waiting))
+        if activated:
+            activated.contracts_activated()
+            activated._post_digest(
+                _("%s contracts activated at once.") % len(activated))
+        return True
+
+    @api.multi
+    def _post_digest(self, body):
+        """ Post one note in the chatter of all contracts with a single
+        query, in place of the tracking of each contract.
+        :param body: content of the note
+        :return: None
+        """
+        now = fields.Datetime.now()
+        self.env.cr.execute("""
+            INSERT INTO mail_message (
+                model, res_id, record_name, body, message_type, subtype_id,
+                author_id, date, create_uid, create_date, write_uid,
+                write_date)
+            SELECT 'recurring.contract', c.id, c.reference, %(body)s,
+                'notification', %(subtype_id)s, %(author_id)s, %(now)s,
+                %(uid)s, %(now)s, %(uid)s, %(now)s
+            FROM recurring_contract c
+            WHERE c.id = ANY(%(ids)s)
+        """, {
+            'ids': self.ids, 'body': f"<p>{html.escape(body)}</p>",
+            'subtype_id': self.env.ref('mail.mt_note').id,
+            'author_id': self.env.user.partner_id.id,
+            'uid': self.env.uid, 'now': now,
+        })
+        self.invalidate_cache(['message_ids'], self.ids)
+
+    @api.multi
+    def _split_in_group_chunks(self):
+        """ Split the contracts in chunks of payment options, so that all
+        contracts of a group are processed by the same job.
+        :return: list of recurring.contract recordsets
+        """
+        contract_ids_by_group = dict()
+        for contract in self:
+            contract_ids_by_group.setdefault(
+                contract.group_id.id, list()).append(contract.id)
+        group_ids = list(contract_ids_by_group)
+        size = self.env['recurring.contract.group']._get_job_chunk_size()
+        return [
+            self.browse([
+                contract_id for group_id in group_ids[i:i + size]
+                for contract_id in contract_ids_by_group[group_id]
+            ]) for i in range(0, len(group_ids), size)
+        ]
+
+    @api.multi
+    def _terminate_by_partner(self):
+        """ Terminate the contracts, then clean and reconcile again their
+        invoices with one pass for all contracts of a partner.
+        :return: True
+        """
+        # Only the job entry point commits the partners: nested calls
+        # must not commit the transaction of their caller.
+        commit_partners = self.env.context.get('commit_partners') and \
+            not test_mode
+        if commit_partners:
+            self = self.with_context(commit_partners=False)
+        contracts = self.filtered(
+            lambda c: c.state not in ('terminated', 'cancelled'))
+        contract_ids_by_partner = dict()
+        for contract in contracts:
+            contract_ids_by_partner.setdefault(
+                contract.partner_id.id, list()).append(contract.id)
+        for contract_ids in contract_ids_by_partner.values():
+            partner_contracts = self.browse(contract_ids)
+            partner_contracts.with_context(
+                batch_terminate=True).action_contract_terminate()
+            partner_contracts._clean_invoices(
+                fields.Datetime.now(), clean_invoices_paid=True)
+            # Commit each partner inside jobs, so that a retry of the job
+            # only processes the remaining contracts.
+            if commit_partners:
+                self.env.cr.commit()  # pylint: disable=invalid-commit
+        return True
+
+    @api.multi
+    def _terminate_by_partner_job(self):
+        """ Job terminating the contracts, committing each partner.
+        :return: True
+        """
+        return self.with_context(commit_partners=True)._terminate_by_partner()
+
+    @api.multi
+    def _end_contracts(self, end_reason_id, end_date, notes=None,
+                       wizard_id=None):
+        """ End a chunk of contracts from the end contract wizard. Contracts
+        ending in the future are terminated later by the CRON.
+        :param end_reason_id: recurring.contract.end.reason id
+        :param end_date: datetime of the end of the contracts
+        :param notes: text posted in the chatter of the contracts
+        :param wizard_id: end.contract.wizard id where the progress is
+                          reported, if it still exists
+        :return: True
+        """
+        if isinstance(end_date, str):
+            end_date = fields.Datetime.from_string(end_date)
+        self.write({
+            'end_reason_id': end_reason_id,
+            'end_date': end_date
+        })
+        if notes:
+            self.message_post(body=notes)
+        if end_date <= datetime.now():
+            self._terminate_by_partner()
+        if wizard_id:
+            self.env.cr.execute("""
+                UPDATE end_contract_wizard
+                SET nb_processed = nb_processed + %(count)s,
+                    state = CASE WHEN nb_processed + %(count)s >= nb_contracts
+                            THEN 'done' ELSE state END,
+                    write_date = (now() AT TIME ZONE 'UTC')
+                WHERE id = %(id)s
+            """, {'count': len(self), 'id': wizard_id})
+            self.env['end.contract.wizard'].browse(
+                wizard_id).invalidate_cache(['nb_processed', 'state'])
+        return True
+
+    @api.multi
+    def _end_contracts_job(self, end_reason_id, end_date, notes=None,
+                           wizard_id=None):
+        """ Job ending the contracts, committing each terminated partner.
+        :return: True
+        """
+        return self.with_context(commit_partners=True)._end_contracts(
+            end_reason_id, end_date, notes, wizard_id)
+
+    @api.model
+    def _move_invoices_to_partners(self, partner_by_invoice):
+        """ Give unpaid invoices to other partners, with their journal
+        entries, using set-based updates. The journal items are given to
+        the commercial partners and the receivable account of the new
+        partners is used, as when the invoices are validated.
+        :param partner_by_invoice: dict {invoice_id: new partner_id}
+        :return: None
+        """
+        cr = self.env.cr
+        cr.execute("""
+            SELECT id, company_id, account_id FROM account_invoice
+            WHERE id = ANY(%s)
+        """, [list(partner_by_invoice)])
+        partner_obj = self.env['res.partner']
+        receivable_ids = dict()
+        rows = list()
+        for invoice_id, company_id, account_id in cr.fetchall():
+            partner = partner_obj.browse(partner_by_invoice[invoice_id])
+            commercial_partner = partner.commercial_partner_id
+            key = (commercial_partner.id, company_id)
+            if key not in receivable_ids:
+                receivable_ids[key] = commercial_partner.with_context(
+                    force_company=company_id).property_account_receivable_id.id
+            rows.append((invoice_id, partner.id, commercial_partner.id,
+                         receivable_ids[key] or account_id, account_id))
+        cr.execute("""
+            CREATE TEMP TABLE recurring_invoice_partner AS
+            SELECT * FROM unnest(
+                %s::int[], %s::int[], %s::int[], %s::int[], %s::int[]
+            ) AS t(invoice_id, partner_id, commercial_partner_id,
+                   account_id, old_account_id)
+        """, [list(column) for column in zip(*rows)])
+        cr.execute("""
+            UPDATE account_invoice i
+            SET partner_id = t.partner_id,
+                commercial_partner_id = t.commercial_partner_id,
+                account_id = t.account_id
+            FROM recurring_invoice_partner t
+            WHERE i.id = t.invoice_id;
+
+            UPDATE account_invoice_line l
+            SET partner_id = t.partner_id
+            FROM recurring_invoice_partner t
+            WHERE l.invoice_id = t.invoice_id;
+
+            UPDATE account_move m
+            SET partner_id = t.commercial_partner_id
+            FROM recurring_invoice_partner t
+            JOIN account_invoice i ON i.id = t.invoice_id
+            WHERE m.id = i.move_id;
+
+            UPDATE account_move_line ml
+            SET partner_id = t.commercial_partner_id,
+                account_id = CASE WHEN ml.account_id = t.old_account_id
+                             THEN t.account_id ELSE ml.account_id END
+            FROM recurring_invoice_partner t
+            JOIN account_invoice i ON i.id = t.invoice_id
+            WHERE ml.move_id = i.move_id;
+
+            DROP TABLE recurring_invoice_partner;
+        """)
+        invoices = self.env['account.invoice'].browse(list(partner_by_invoice))
+        invoices.invalidate_cache(
+            ['partner_id', 'commercial_partner_id', 'account_id'],
+            invoices.ids)
+        invoice_lines = invoices.mapped('invoice_line_ids')
+        invoice_lines.invalidate_cache(['partner_id'], invoice_lines.ids)
+        moves = invoices.mapped('move_id')
+        moves.invalidate_cache(['partner_id'], moves.ids)
+        moves.mapped('line_ids').invalidate_cache(
+            ['partner_id', 'account_id'], moves.mapped('line_ids').ids)
+
+    @api.multi
+    def _log_state_history(self, date=None):
+        """ Close the history periods of the contracts whose state changed
+        and open a period with their current state.
+        :param date: datetime of the change (now by default)
+        :return: None
+        """
+        if not self:
+            return
+        self.env.cr.execute("""
+            WITH closed AS (
+                UPDATE recurring_contract_state_history h
+                SET valid_to = %(date)s
+                FROM recurring_contract c
+                WHERE c.id = h.contract_id
+                AND c.id = ANY(%(ids)s)
+                AND h.valid_to IS NULL AND h.state != c.state
+            )
+            INSERT INTO recurring_contract_state_history (
+                contract_id, state, valid_from)
+            SELECT c.id, c.state, %(date)s
+            FROM recurring_contract c
+            WHERE c.id = ANY(%(ids)s)
+            AND NOT EXISTS (
+                SELECT 1 FROM recurring_contract_state_history h
+                WHERE h.contract_id = c.id AND h.valid_to IS NULL
+                AND h.state = c.state
+            )
+        """, {'ids': self.ids, 'date': date or fields.Datetime.now()})
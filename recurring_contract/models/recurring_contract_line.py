@@ -9,6 +9,7 @@
 ##############################################################################
 
 import logging
+from datetime import datetime, time
 
 import odoo.addons.decimal_precision as dp
 
@@ -49,3 +50,61 @@ class ContractLine(models.Model):
             self.amount = 0.0
         else:
             self.amount = self.product_id.list_price
+
+    @api.model
+    def reprice(self, product, old_price, new_price, effective_date):
+        """ Change the price of all running contract lines selling a product
+        at a given price, and amend the open invoices accordingly.
+        All lines are updated at once and only the stored totals are
+        recomputed, so that contracts are not cleaned one by one.
+        A change effective in the future is scheduled at the effective date,
+        so that the invoices due before keep the old price.
+        :param product: product.product record
+        :param old_price: current price of the lines to update
+        :param new_price: new price of the lines
+        :param effective_date: invoices due from this date are amended
+        :return: recurring.contract.line recordset updated
+        """
+        effective_date = fields.Date.to_date(effective_date)
+        if effective_date > fields.Date.today():
+            self.with_delay(
+                eta=datetime.combine(effective_date, time.min)
+            )._reprice_job(product, old_price, new_price, effective_date)
+            return self.browse()
+        precision = self.env['decimal.precision'].precision_get('Account')
+        self.env.cr.execute("""
+            UPDATE recurring_contract_line l
+            SET amount = %(new_price)s
+            FROM recurring_contract c
+            WHERE c.id = l.contract_id
+            AND l.product_id = %(product_id)s
+            AND ROUND(l.amount::numeric, %(precision)s) =
+                ROUND(%(old_price)s::numeric, %(precision)s)
+            AND c.state NOT IN ('terminated', 'cancelled')
+            RETURNING l.id, l.contract_id
+        """, {
+            'new_price': new_price, 'old_price': old_price,
+            'product_id': product.id, 'precision': precision
+        })
+        rows = self.env.cr.fetchall()
+        lines = self.browse([r[0] for r in rows])
+        contracts = self.env['recurring.contract'].browse(
+            list({r[1] for r in rows}))
+        if not lines:
+            return lines
+        # The subtotals and totals are computed as for any price change
+        lines.invalidate_cache(['amount'], lines.ids)
+        lines.modified(['amount'])
+        lines.recompute()
+        contracts._amend_invoices_price(
+            product, old_price, new_price, effective_date)
+        return lines
+
+    @api.model
+    def _reprice_job(self, product, old_price, new_price, effective_date):
+        """ Job changing the price of the contract lines, committing each
+        window of amended invoices.
+        :return: recurring.contract.line recordset updated
+        """
+        return self.with_context(commit_windows=True).reprice(
+            product, old_price, new_price, effective_date)
@@ -0,0 +1,50 @@
+##############################################################################
+#
+#    Copyright (C) 2021 Compassion CH (http://www.compassion.ch)
+#    Releasing children from poverty in Jesus' name
+#
+#    The licence is in the file __manifest__.py
+#
+##############################################################################
+
+from odoo import api, fields, models, tools
+
+DEFAULT_TRANSIT_ACCOUNT_CODE = '1050'
+
+
+class ResCompany(models.Model):
+    _inherit = 'res.company'
+
+    transit_account_id = fields.Many2one(
+        'account.account', 'Payments transit account', readonly=False,
+        help='Account where open payments are waiting to be reconciled '
+             'with the contract invoices. If not set, the account with code '
+             + DEFAULT_TRANSIT_ACCOUNT_CODE + ' is used.')
+
+    @api.multi
+    def write(self, vals):
+        res = super().write(vals)
+        if 'transit_account_id' in vals:
+            self.clear_caches()
+            self.env['recurring.partner.credit'].refresh_open_credit()
+        return res
+
+    @api.model
+    def get_transit_account_ids(self):
+        """ Get the transit accounts of all companies.
+        :return: list of account.account ids
+        """
+        return list(self._get_transit_account_ids())
+
+    @tools.ormcache()
+    def _get_transit_account_ids(self):
+        account_ids = list()
+        for company in self.sudo().search([]):
+            account = company.transit_account_id or self.env[
+                'account.account'].sudo().search([
+                    ('code', '=', DEFAULT_TRANSIT_ACCOUNT_CODE),
+                    ('company_id', '=', company.id)
+                ], limit=1)
+            if account:
+                account_ids.append(account.id)
+        return tuple(account_ids)
@@ -0,0 +1,26 @@
+##############################################################################
+#
+#    Copyright (C) 2021 Compassion CH (http://www.compassion.ch)
+#    Releasing children from poverty in Jesus' name
+#
+#    The licence is in the file __manifest__.py
+#
+##############################################################################
+
+from odoo import fields, models
+
+
+class ResPartner(models.Model):
+    _inherit = 'res.partner'
+
+    open_credit_ids = fields.One2many(
+        'recurring.partner.credit', 'partner_id', readonly=True)
+    open_transit_credit = fields.Float(
+        'Unmatched payments', compute='_compute_open_transit_credit')
+
+    def _compute_open_transit_credit(self):
+        company = self.env.user.company_id
+        for partner in self:
+            partner.open_transit_credit = sum(
+                partner.open_credit_ids.filtered(
+                    lambda c: c.company_id == company).mapped('open_credit'))
@@ -0,0 +1 @@
+from . import contract_kpi
@@ -0,0 +1,234 @@
+##############################################################################
+#
+#    Copyright (C) 2021 Compassion CH (http://www.compassion.ch)
+#    Releasing children from poverty in Jesus' name
+#
+#    The licence is in the file __manifest__.py
+#
+##############################################################################
+
+import hashlib
+import logging
+
+from odoo import api, fields, models, tools
+
+_logger = logging.getLogger(__name__)
+
+
+class ContractKpi(models.Model):
+    """ Monthly and daily snapshots of the contract KPIs by company,
+    product, UTM medium, payment mode and end reason. Daily snapshots are
+    kept for the last months given by the system parameter
+    recurring_contract.kpi_daily_months.
+    The closed months are stored in a materialized view that is refreshed
+    concurrently, while the current month is stored in a small table that
+    is refreshed incrementally. """
+
+    _name = "recurring.contract.kpi"
+    _description = "Contract KPI"
+    _auto = False
+    _order = "date desc, period"
+    _rec_name = "date"
+
+    period = fields.Selection([
+        ('day', 'Day'),
+        ('month', 'Month'),
+    ], readonly=True)
+    date = fields.Date(readonly=True)
+    company_id = fields.Many2one('res.company', 'Company', readonly=True)
+    product_id = fields.Many2one('product.product', 'Product', readonly=True)
+    medium_id = fields.Many2one('utm.medium', 'Medium', readonly=True)
+    payment_mode_id = fields.Many2one(
+        'account.payment.mode', 'Payment mode', readonly=True)
+    end_reason_id = fields.Many2one(
+        'recurring.contract.end.reason', 'End reason', readonly=True)
+    active_count = fields.Integer('Active contracts', readonly=True)
+    new_count = fields.Integer('New contracts', readonly=True)
+    churn_count = fields.Integer('Terminated contracts', readonly=True)
+    mrr = fields.Float('Monthly recurring revenue', readonly=True)
+
+    def _select_kpi(self, periods):
+        """
+        :param periods: SQL query giving the periods to compute in columns
+                        period, date (first day) and date_end (first day
+                        after the period)
+        :return: SQL query computing the KPIs of the given periods
+        """
+        return f"""
+            WITH periods AS ({periods})
+            SELECT
+                p.period, p.date, c.company_id, l.product_id, c.medium_id,
+                c.payment_mode_id, c.end_reason_id,
+                COUNT(DISTINCT c.id) FILTER (
+                    WHERE c.end_date IS NULL
+                    OR c.end_date >= p.date_end
+                ) AS active_count,
+                COUNT(DISTINCT c.id) FILTER (
+                    WHERE c.activation_date >= p.date
+                ) AS new_count,
+                COUNT(DISTINCT c.id) FILTER (
+                    WHERE c.state = 'terminated'
+                    AND c.end_date < p.date_end
+                ) AS churn_count,
+                COALESCE(SUM(
+                    l.subtotal * CASE g.recurring_unit
+                        WHEN 'day' THEN 365.0 / 12
+                        WHEN 'week' THEN 52.0 / 12
+                        WHEN 'year' THEN 1.0 / 12
+                        ELSE 1.0
+                    END / GREATEST(g.recurring_value, 1)
+                ) FILTER (
+                    WHERE c.end_date IS NULL
+                    OR c.end_date >= p.date_end
+                ), 0) AS mrr
+            FROM periods p
+            JOIN recurring_contract c
+                ON c.activation_date < p.date_end
+                AND (c.end_date IS NULL OR c.end_date >= p.date)
+            JOIN recurring_contract_line l ON l.contract_id = c.id
+            JOIN recurring_contract_group g ON g.id = c.group_id
+            GROUP BY p.period, p.date, c.company_id, l.product_id,
+                     c.medium_id, c.payment_mode_id, c.end_reason_id
+        """
+
+    def _history_periods(self):
+        """ The closed months, and the days of the closed months for which
+        daily snapshots are kept. """
+        return """
+            WITH bounds AS (
+                SELECT MIN(activation_date) AS first_date,
+                    date_trunc('month', now()) AS current_month,
+                    COALESCE((
+                        SELECT value::int FROM ir_config_parameter
+                        WHERE key = 'recurring_contract.kpi_daily_months'
+                    ), 3) AS daily_months
+                FROM recurring_contract
+            )
+            SELECT 'month' AS period, d::date AS date,
+                (d + interval '1 month')::date AS date_end
+            FROM bounds, generate_series(
+                date_trunc('month', first_date),
+                current_month - interval '1 month',
+                interval '1 month') d
+            UNION ALL
+            SELECT 'day', d::date, (d + interval '1 day')::date
+            FROM bounds, generate_series(
+                GREATEST(date_trunc('day', first_date),
+                         current_month - daily_months * interval '1 month'),
+                current_month - interval '1 day',
+                interval '1 day') d
+        """
+
+    def _current_periods(self):
+        """ The current month and its days until today. """
+        return """
+            SELECT 'month' AS period, date_trunc('month', now())::date AS date,
+                (date_trunc('month', now()) + interval '1 month')::date
+                    AS date_end
+            UNION ALL
+            SELECT 'day', d::date, (d + interval '1 day')::date
+            FROM generate_series(
+                date_trunc('month', now()), date_trunc('day', now()),
+                interval '1 day') d
+        """
+
+    @api.model_cr
+    def init(self):
+        columns = """
+            period, date, company_id, product_id, medium_id,
+            payment_mode_id, end_reason_id, active_count, new_count,
+            churn_count, mrr
+        """
+        history = f"""
+            SELECT row_number() OVER () AS id, kpi.*
+            FROM ({self._select_kpi(self._history_periods())}) kpi
+        """
+        current = f"""
+            SELECT row_number() OVER () AS id, kpi.*
+            FROM ({self._select_kpi(self._current_periods())}) kpi
+        """
+        view = f"""
+            SELECT id, {columns}
+            FROM recurring_contract_kpi_history
+            UNION ALL
+            SELECT -id, {columns}
+            FROM recurring_contract_kpi_current
+        """
+        # The snapshots are only computed again when the queries change,
+        # which is detected with a checksum stored as comment of the view.
+        checksum = hashlib.md5(
+            (history + current + view).encode()).hexdigest()
+        self.env.cr.execute("""
+            SELECT obj_description(
+                to_regclass('recurring_contract_kpi_history'), 'pg_class')
+        """)
+        if self.env.cr.fetchone()[0] == checksum:
+            return
+        tools.drop_view_if_exists(self.env.cr, self._table)
+        self.env.cr.execute(f"""
+            DROP MATERIALIZED VIEW IF EXISTS recurring_contract_kpi_history;
+            CREATE MATERIALIZED VIEW recurring_contract_kpi_history AS
+            {history}
+            WITH DATA;
+            CREATE UNIQUE INDEX recurring_contract_kpi_history_id_index
+            ON recurring_contract_kpi_history (id);
+            COMMENT ON MATERIALIZED VIEW recurring_contract_kpi_history
+            IS %s;
+
+            DROP TABLE IF EXISTS recurring_contract_kpi_current;
+            CREATE TABLE recurring_contract_kpi_current AS
+            {current};
+
+            CREATE VIEW {self._table} AS ({view});
+        """, [checksum])
+        _logger.info("Contract KPI snapshots computed.")
+
+    @api.model
+    def refresh_history(self):
+        """ Refresh the KPIs of the closed months. The refresh is done
+        concurrently so that reports can still be read meanwhile. """
+        self.env.cr.execute("""
+            SELECT ispopulated FROM pg_matviews
+            WHERE matviewname = 'recurring_contract_kpi_history'
+        """)
+        concurrently = "CONCURRENTLY" if self.env.cr.fetchone()[0] else ""
+        self.env.cr.execute(
+            f"REFRESH MATERIALIZED VIEW {concurrently} "
+            f"recurring_contract_kpi_history")
+        _logger.info("Contract KPI history refreshed.")
+        return True
+
+    @api.model
+    def refresh_current_month(self):
+        """ Incremental refresh: compute again only the current month. """
+        self.env.cr.execute(f"""
+            DELETE FROM recurring_contract_kpi_current;
+            INSERT INTO recurring_contract_kpi_current
+            SELECT row_number() OVER () AS id, kpi.*
+            FROM ({self._select_kpi(self._current_periods())}) kpi;
+        """)
+        return True
+
+    @api.model
+    def cron_refresh(self):
+        """ Refresh the current month, and the history when it is outdated
+        (at the beginning of a new month or if it was never computed). """
+        self.refresh_current_month()
+        # An unpopulated materialized view can't be scanned
+        self.env.cr.execute("""
+            SELECT ispopulated FROM pg_matviews
+            WHERE matviewname = 'recurring_contract_kpi_history'
+        """)
+        outdated = not self.env.cr.fetchone()[0]
+        if not outdated:
+            self.env.cr.execute("""
+                SELECT NOT EXISTS (
+                    SELECT 1 FROM recurring_contract_kpi_history
+                    WHERE period = 'month' AND date = (
+                        date_trunc('month', now()) - interval '1 month')
+                )
+            """)
+            outdated = self.env.cr.fetchone()[0]
+        if outdated:
+            self.refresh_history()
+        return True
@@ -0,0 +1,179 @@
+##############################################################################
+#
+#    Copyright (C) 2021 Compassion CH (http://www.compassion.ch)
+#    Releasing children from poverty in Jesus' name
+#
+#    The licence is in the file __manifest__.py
+#
+##############################################################################
+
+import logging
+import time
+from contextlib import contextmanager
+from datetime import date
+
+from dateutil.relativedelta import relativedelta
+
+from odoo.tests.common import TransactionCase, tagged
+
+logger = logging.getLogger(__name__)
+
+
+@tagged('post_install', '-at_install', '-standard', 'benchmark')
+class TestReconcileBenchmark(TransactionCase):
+    """
+        Benchmark of the reconciliation paths with partners having many open
+        payments and invoices. Each path is timed and its SQL queries are
+        counted. The test fails when a budget is exceeded.
+        It doesn't run with the standard tests: use --test-tags benchmark.
+    """
+    # Budgets for each path: (maximum seconds, maximum SQL queries)
+    BUDGETS = {
+        'reconcile_after_clean': (30.0, 6000),
+        'group_reconcile': (10.0, 1500),
+        'split_reconcile': (10.0, 1500),
+        'split_payment_and_reconcile': (5.0, 400),
+        'find_payment_combination': (1.0, 50),
+    }
+    NB_PARTNERS = 20
+    NB_PAYMENTS = 200
+
+    def setUp(self):
+        super().setUp()
+        self.env['account.journal'].search([]).write({'update_posted': True})
+        self.company = self.env.user.company_id
+        self.receivable = self.env['account.account'].search([
+            ('user_type_id.type', '=', 'receivable'),
+            ('company_id', '=', self.company.id)
+        ], limit=1)
+        self.company.transit_account_id = self.receivable
+        self.bank_journal = self.env['account.journal'].search([
+            ('type', '=', 'bank'), ('company_id', '=', self.company.id)
+        ], limit=1)
+        self.sale_journal = self.env['account.journal'].search([
+            ('type', '=', 'sale'), ('company_id', '=', self.company.id)
+        ], limit=1)
+        self.product = self.env.ref('product.product_product_6')
+        self.partners = self.env['res.partner'].create([
+            {'name': f'Benchmark sponsor {i}',
+             'property_account_receivable_id': self.receivable.id}
+            for i in range(self.NB_PARTNERS)
+        ])
+
+    @contextmanager
+    def budget(self, path):
+        max_seconds, max_queries = self.BUDGETS[path]
+        queries = self.env.cr.sql_log_count
+        start = time.perf_counter()
+        yield
+        runtime = time.perf_counter() - start
+        queries = self.env.cr.sql_log_count - queries
+        logger.info(f"Benchmark {path}: {runtime:.3f}s, {queries} queries")
+        self.assertLessEqual(
+            runtime, max_seconds, f"{path} exceeded its time budget")
+        self.assertLessEqual(
+            queries, max_queries, f"{path} exceeded its queries budget")
+
+    def create_payments(self, partner, amounts):
+        """ Create one posted move holding an open payment for each amount,
+        as a bank statement would do. """
+        lines = [(0, 0, {
+            'name': f'Payment {i}',
+            'partner_id': partner.id,
+            'account_id': self.receivable.id,
+            'credit': amount,
+            'date_maturity': date.today(),
+        }) for i, amount in enumerate(amounts)]
+        lines.append((0, 0, {
+            'name': 'Bank',
+            'account_id': self.bank_journal.default_debit_account_id.id,
+            'debit': sum(amounts),
+        }))
+        move = self.env['account.move'].create({
+            'journal_id': self.bank_journal.id,
+            'date': date.today(),
+            'line_ids': lines,
+        })
+        move.post()
+        return move.line_ids.filtered('credit')
+
+    def create_invoices(self, partner, amounts, start=None):
+        start = start or date.today()
+        invoices = self.env['account.invoice']
+        for i, amount in enumerate(amounts):
+            invoices |= invoices.create({
+                'partner_id': partner.id,
+                'account_id': self.receivable.id,
+                'journal_id': self.sale_journal.id,
+                'type': 'out_invoice',
+                'date_invoice': start + relativedelta(months=i),
+                'invoice_line_ids': [(0, 0, {
+                    'name': self.product.name,
+                    'product_id': self.product.id,
+                    'price_unit': amount,
+                    'quantity': 1,
+                    'account_id':
+                        self.product.property_account_income_id.id or
+                        invoices.invoice_line_ids._default_account(),
+                })],
+            })
+        invoices.action_invoice_open()
+        return invoices
+
+    def test_reconcile_after_clean(self):
+        invoices = self.env['account.invoice']
+        for partner in self.partners:
+            # One exact match for the past, the future needs a group
+            past = self.create_invoices(
+                partner, [42.0], date.today() - relativedelta(months=1))
+            future = self.create_invoices(
+                partner, [42.0] * 3, date.today() + relativedelta(months=1))
+            self.create_payments(partner, [42.0] + [21.0] * 6)
+            invoices |= past | future
+        invoices.action_invoice_cancel()
+        with self.budget('reconcile_after_clean'):
+            invoices.reconcile_after_clean()
+        self.assertEqual(
+            len(invoices.filtered(lambda i: i.state == 'paid')),
+            self.NB_PARTNERS)
+
+    def test_group_reconcile(self):
+        partner = self.partners[0]
+        amounts = [round(1 + (i * 7.3) % 50, 2) for i in range(
+            self.NB_PAYMENTS)]
+        self.create_payments(partner, amounts)
+        target = sum(amounts[-5:])
+        invoice = self.create_invoices(partner, [target])
+        with self.budget('group_reconcile'):
+            invoice._group_or_split_reconcile()
+        self.assertEqual(invoice.state, 'paid')
+
+    def test_split_reconcile(self):
+        partner = self.partners[0]
+        self.create_payments(partner, [500.0] + [10.0] * self.NB_PAYMENTS)
+        invoice = self.create_invoices(partner, [333.0])
+        with self.budget('split_reconcile'):
+            invoice._group_or_split_reconcile()
+        self.assertEqual(invoice.state, 'paid')
+
+    def test_split_payment_and_reconcile(self):
+        partner = self.partners[0]
+        payments = self.create_payments(
+            partner, [100.0] + [5.0] * self.NB_PAYMENTS)
+        invoice = self.create_invoices(partner, [60.0])
+        debit = invoice.move_id.line_ids.filtered('debit')
+        with self.budget('split_payment_and_reconcile'):
+            (payments[0] | debit).split_payment_and_reconcile()
+        self.assertEqual(invoice.state, 'paid')
+        self.assertEqual(len(payments[0].move_id.line_ids),
+                         self.NB_PAYMENTS + 3)
+
+    def test_find_payment_combination(self):
+        partner = self.partners[0]
+        amounts = [round(1 + (i * 13.7) % 80, 2) for i in range(
+            self.NB_PAYMENTS)]
+        payments = self.create_payments(partner, amounts)
+        target = sum(amounts[100:110])
+        with self.budget('find_payment_combination'):
+            matching = payments.find_payment_combination(target)
+        self.assertAlmostEqual(sum(matching.mapped('credit')), target)
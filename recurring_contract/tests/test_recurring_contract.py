@@ -10,11 +10,16 @@
 
 from odoo.tools import DEFAULT_SERVER_DATE_FORMAT as DF
 from odoo import fields
+from odoo.exceptions import UserError, ValidationError
 from odoo.tests.common import TransactionCase
+import base64
+import json
 import logging
 import random
+from unittest import mock
 import string
 from datetime import datetime
+from dateutil.relativedelta import relativedelta
 logger = logging.getLogger(__name__)
 
 
@@ -242,6 +247,8 @@ class TestRecurringContract(BaseContractTest):
 
         # We put the third contract in terminate state to see if
         # the invoice is well updated
+        self.env["ir.config_parameter"].set_param(
+            "recurring_contract.clean_inline_limit", 0)
         contract3.with_context(async_mode=True).action_contract_terminate()
         # Check a job for cleaning invoices has been created
         self.assertTrue(self.env['queue.job'].search([
@@ -265,21 +272,33 @@ class BaseContractCompassionTest(BaseContractTest):
         default_values.update(vals)
         return super().create_contract(default_values, line_vals)
 
-    def _pay_invoice(self, invoice):
+    def _create_payment(self, partner, amount, payment_date=None,
+                        invoices=None):
         bank_journal = self.env['account.journal'].search(
             [('code', '=', 'BNK1')], limit=1)
-        payment = self.env['account.payment'].create({
+        vals = {
             'journal_id': bank_journal.id,
-            'amount': invoice.amount_total,
-            'payment_date': invoice.date_due,
+            'amount': amount,
             'payment_type': 'inbound',
             'payment_method_id': bank_journal.inbound_payment_method_ids[0].id,
             'partner_type': 'customer',
-            'partner_id': invoice.partner_id.id,
-            'currency_id': invoice.currency_id.id,
-            'invoice_ids': [(6, 0, invoice.ids)]
-        })
+            'partner_id': partner.id,
+        }
+        if payment_date:
+            vals['payment_date'] = payment_date
+        if invoices:
+            vals.update({
+                'currency_id': invoices[0].currency_id.id,
+                'invoice_ids': [(6, 0, invoices.ids)]
+            })
+        payment = self.env['account.payment'].create(vals)
         payment.post()
+        return payment
+
+    def _pay_invoice(self, invoice, amount=None):
+        return self._create_payment(
+            invoice.partner_id, amount or invoice.amount_total,
+            invoice.date_due, invoice)
 
 
 class TestContractCompassion(BaseContractCompassionTest):
@@ -324,7 +343,16 @@ class TestContractCompassion(BaseContractCompassionTest):
         # Payment of the third invoice so the
         # contract will be on the active state and the 2 first invoices should
         # be cancelled.
-        self._pay_invoice(invoices[3])
+        states = []
+
+        def invoice_paid(contracts, invoice):
+            states.extend(contracts.mapped("state"))
+
+        # The per-invoice hook sees the contract already activated
+        with mock.patch.object(type(contract), "invoice_paid",
+                               autospec=True, side_effect=invoice_paid):
+            self._pay_invoice(invoices[3])
+        self.assertEqual(states, ["active"])
         # For now the test is broken because cancel invoices are done in job.
         # TODO Would be better to launch job synchronously in the test:
         # https://github.com/OCA/queue/issues/89
@@ -596,3 +624,707 @@ class TestContractCompassion(BaseContractCompassionTest):
             ("contract_id", "=", contract.id)]).mapped("invoice_id")
 
         self.assertEqual(len(all_contract_invoice), 4)
+
+    def test_clean_keeps_matching_invoices(self):
+        """Cleaning a group without any change should not touch the
+        invoices that already match the contracts."""
+        contract_group = self.create_group(
+            {
+                "partner_id": self.michel.id,
+                "change_method": "clean_invoices",
+                "advance_billing_months": 2
+            }
+        )
+        contract = self.create_contract(
+            {
+                "partner_id": self.michel.id,
+                "group_id": contract_group.id,
+            },
+            [{"amount": 50.0}])
+
+        contract.contract_waiting()
+        invoices = contract.button_generate_invoices().invoice_ids
+        self.assertEqual(len(invoices), 3)
+        move_names = invoices.mapped("move_name")
+
+        regenerated = contract_group._clean_generate_invoices()
+        self.assertFalse(regenerated)
+        self.assertEqual(invoices.mapped("move_name"), move_names)
+        self.assertEqual(
+            set(invoices.mapped("state")), {"open"})
+        self.assertEqual(
+            len(contract.invoice_line_ids.mapped("invoice_id")), 3)
+
+    def test_clean_skips_partially_paid_invoices(self):
+        """Regenerating invoices doesn't cancel partially paid invoices."""
+        contract_group = self.create_group(
+            {
+                "partner_id": self.michel.id,
+                "advance_billing_months": 2
+            }
+        )
+        contract = self.create_contract(
+            {
+                "partner_id": self.michel.id,
+                "group_id": contract_group.id,
+            },
+            [{"amount": 50.0}])
+        contract.contract_waiting()
+        invoices = contract.button_generate_invoices().invoice_ids.sorted(
+            "date_invoice")
+        partial = invoices[0]
+        self._pay_invoice(partial, 20.0)
+
+        contract.contract_line_ids.write({"amount": 60.0})
+        regenerated = contract_group._clean_generate_invoices()
+        self.assertNotIn(partial, regenerated)
+        self.assertEqual(partial.state, "open")
+        self.assertEqual(partial.amount_total, 50.0)
+        self.assertEqual(set((invoices - partial).mapped("amount_total")),
+                         {60.0})
+
+    def test_group_write_chunked_jobs(self):
+        """Writing on several groups enqueues one cleaning job per chunk."""
+        self.env["ir.config_parameter"].set_param(
+            "recurring_contract.job_chunk_size", 2)
+        groups = self.group_obj
+        for partner in (self.michel, self.thomas, self.david):
+            groups |= self.create_group({
+                "partner_id": partner.id,
+                "change_method": "clean_invoices",
+            })
+        groups.with_context(async_mode=True).write(
+            {"advance_billing_months": 2})
+        jobs = self.env["queue.job"].search([
+            ("func_string", "like", "_clean_generate_invoices")])
+        self.assertEqual(len(jobs), 2)
+        self.assertEqual(set(groups.mapped("advance_billing_months")), {2})
+
+    def test_clean_impact_estimation(self):
+        """The impact estimation counts the invoices that would be cleaned
+        and small cleanings are done immediately."""
+        contract_group = self.create_group(
+            {"partner_id": self.michel.id, "advance_billing_months": 2})
+        contract = self.create_contract(
+            {
+                "partner_id": self.michel.id,
+                "group_id": contract_group.id,
+            },
+            [{"amount": 50.0}])
+        contract.contract_waiting()
+        invoices = contract.button_generate_invoices().invoice_ids
+        self._pay_invoice(invoices.sorted("date_invoice")[-1])
+
+        impact = contract.estimate_clean_impact()
+        self.assertEqual(impact["invoices"], 2)
+        self.assertEqual(impact["lines"], 2)
+        impact = contract.estimate_clean_impact(clean_invoices_paid=True)
+        self.assertEqual(impact["invoices"], 3)
+        self.assertEqual(impact["reconciles"], 1)
+
+        contract.with_context(async_mode=True).clean_invoices()
+        self.assertFalse(self.env["queue.job"].search([
+            ("func_string", "like", "_clean_invoices")]))
+        self.assertEqual(
+            len(invoices.filtered(lambda i: i.state == "cancel")), 2)
+
+    def test_clean_invoices_by_windows(self):
+        """Cleaning by small windows gives the same result."""
+        self.env["ir.config_parameter"].set_param(
+            "recurring_contract.clean_window_size", 2)
+        contract_group = self.create_group(
+            {"partner_id": self.michel.id, "advance_billing_months": 4})
+        contract = self.create_contract(
+            {
+                "partner_id": self.michel.id,
+                "group_id": contract_group.id,
+            },
+            [{"amount": 50.0}])
+        contract.contract_waiting()
+        invoices = contract.button_generate_invoices().invoice_ids
+        self.assertEqual(len(invoices), 5)
+        next_invoice_date = contract.next_invoice_date
+
+        cleaned = contract._clean_invoices()
+        self.assertEqual(cleaned, invoices)
+        self.assertEqual(set(invoices.mapped("state")), {"cancel"})
+        self.assertEqual(contract.next_invoice_date, next_invoice_date)
+
+    def test_clean_window_finishes_its_work(self):
+        """Each window is fully cleaned before the next one, so that a
+        failure in a later window leaves the first ones consistent."""
+        self.env["ir.config_parameter"].set_param(
+            "recurring_contract.clean_window_size", 2)
+        contract_group = self.create_group(
+            {"partner_id": self.michel.id, "advance_billing_months": 4})
+        contract = self.create_contract(
+            {
+                "partner_id": self.michel.id,
+                "group_id": contract_group.id,
+            },
+            [{"amount": 50.0}])
+        contract.contract_waiting()
+        invoices = contract.button_generate_invoices().invoice_ids.sorted(
+            lambda i: (i.date_invoice, i.id))
+
+        clean_lines = type(contract)._clean_invoice_lines
+        calls = []
+
+        def fail_second_window(self, inv_lines, keep_lines=False):
+            calls.append(inv_lines)
+            if len(calls) > 1:
+                raise UserError("Timeout")
+            return clean_lines(self, inv_lines, keep_lines)
+
+        with mock.patch.object(type(contract), "_clean_invoice_lines",
+                               fail_second_window):
+            with self.assertRaises(UserError):
+                contract._clean_invoices()
+        self.assertEqual(set(invoices[:2].mapped("state")), {"cancel"})
+        self.assertEqual(set(invoices[2:].mapped("state")), {"open"})
+
+    def test_reprice_contract_lines(self):
+        """Repricing updates all matching lines, the totals and the open
+        invoices, but not the paid ones."""
+        contract_group = self.create_group(
+            {"partner_id": self.michel.id, "advance_billing_months": 2})
+        contract = self.create_contract(
+            {
+                "partner_id": self.michel.id,
+                "group_id": contract_group.id,
+            },
+            [{"amount": 42.0, "quantity": 2}])
+        contract2 = self.create_contract(
+            {
+                "partner_id": self.michel.id,
+                "group_id": contract_group.id,
+            },
+            [{"amount": 42.0}, {"amount": 10.0}])
+        (contract + contract2).contract_waiting()
+        invoices = contract.button_generate_invoices().invoice_ids.sorted(
+            "date_invoice")
+        self.assertEqual(len(invoices), 3)
+        self._pay_invoice(invoices[0])
+        line_obj = self.env["recurring.contract.line"]
+
+        # A future price is applied at the effective date
+        self.assertFalse(line_obj.reprice(
+            self.product, 42.0, 45.0,
+            fields.Date.today() + relativedelta(days=1)))
+        self.assertEqual(contract.total_amount, 84.0)
+        self.assertTrue(self.env["queue.job"].search([
+            ("func_string", "like", "_reprice_job")]))
+
+        # Invoices having payments can't be amended
+        self._pay_invoice(invoices[1], 10.0)
+        lines = line_obj.reprice(
+            self.product, 42.0, 45.0, fields.Date.today())
+        self.assertEqual(len(lines), 2)
+        self.assertEqual(contract.total_amount, 90.0)
+        self.assertEqual(contract2.total_amount, 55.0)
+        self.assertEqual(invoices[0].amount_total, 136.0)
+        self.assertEqual(invoices[1].amount_total, 136.0)
+        self.assertEqual(invoices[2].state, "open")
+        self.assertEqual(invoices[2].amount_total, 145.0)
+
+    def test_find_payment_combination(self):
+        """The matcher finds an exact combination among many payments and
+        prefers the oldest ones."""
+        amounts = [7.3, 12.5, 3.2, 50.0, 12.5, 20.0] + [99.99] * 50
+        payment_lines = self.env["account.move.line"]
+        for day, amount in enumerate(amounts, start=1):
+            payment = self._create_payment(
+                self.david, amount, datetime(2019, 1, 1 + day % 28).date())
+            payment_lines |= payment.move_line_ids.filtered("credit")
+
+        matching = payment_lines.find_payment_combination(23.0)
+        self.assertEqual(sorted(matching.mapped("credit")), [3.2, 7.3, 12.5])
+        self.assertEqual(
+            matching.filtered(lambda l: l.credit == 12.5),
+            payment_lines.filtered(lambda l: l.credit == 12.5)[0])
+        self.assertAlmostEqual(
+            sum(payment_lines.find_payment_combination(499.95)
+                .mapped("credit")), 499.95)
+        self.assertFalse(payment_lines.find_payment_combination(1.0))
+
+    def test_split_payment_in_place(self):
+        """Splitting a payment keeps the move posted and balanced."""
+        contract_group = self.create_group({"partner_id": self.michel.id})
+        contract = self.create_contract(
+            {
+                "partner_id": self.michel.id,
+                "group_id": contract_group.id,
+            },
+            [{"amount": 30.0}])
+        contract.contract_waiting()
+        invoice = contract.button_generate_invoices().invoice_ids[:1]
+        payment = self._create_payment(
+            self.michel, 100.0, invoice.date_invoice)
+        payment_line = payment.move_line_ids.filtered("credit")
+        move = payment_line.move_id
+        invoice_lines = invoice.move_id.line_ids.filtered(
+            lambda l: l.account_id == payment_line.account_id)
+
+        (payment_line | invoice_lines).split_payment_and_reconcile()
+        self.assertEqual(move.state, "posted")
+        self.assertEqual(len(move.line_ids), 3)
+        self.assertEqual(payment_line.credit, 30.0)
+        self.assertTrue(payment_line.reconciled)
+        self.assertEqual(invoice.state, "paid")
+        residual = move.line_ids.filtered(
+            lambda l: l.credit and l != payment_line)
+        self.assertEqual(residual.credit, 70.0)
+        self.assertFalse(residual.reconciled)
+
+    def test_bank_statement_notes_deferred(self):
+        """Paying invoices only marks them for a deferred notes posting."""
+        contract_group = self.create_group({"partner_id": self.michel.id})
+        contract = self.create_contract(
+            {
+                "partner_id": self.michel.id,
+                "group_id": contract_group.id,
+            },
+            [{"amount": 30.0}])
+        contract.contract_waiting()
+        invoice = contract.button_generate_invoices().invoice_ids[:1]
+        self._pay_invoice(invoice)
+        self.assertTrue(invoice.bank_statement_notes_pending)
+        jobs = self.env["queue.job"].search([
+            ("func_string", "like", "_post_pending_bank_statement_notes")])
+        self.assertEqual(len(jobs), 1)
+
+        self.env["account.invoice"]._post_pending_bank_statement_notes()
+        self.assertFalse(invoice.bank_statement_notes_pending)
+
+    def test_partner_open_credit(self):
+        """The open credit of a partner follows its open payments."""
+        receivable = self.david.property_account_receivable_id
+        self.env.user.company_id.transit_account_id = receivable
+        credit_obj = self.env["recurring.partner.credit"]
+        initial_credit = credit_obj.get_open_credit(self.david)
+        payment = self._create_payment(self.david, 80.0)
+        self.assertAlmostEqual(
+            credit_obj.get_open_credit(self.david), initial_credit + 80.0)
+        self.assertAlmostEqual(
+            self.david.open_transit_credit, initial_credit + 80.0)
+
+        payment.cancel()
+        self.assertAlmostEqual(
+            credit_obj.get_open_credit(self.david), initial_credit)
+
+    def test_last_paid_invoice_date(self):
+        """The stored last paid invoice date follows the invoice payments."""
+        contract_group = self.create_group(
+            {"partner_id": self.michel.id, "advance_billing_months": 2})
+        contract = self.create_contract(
+            {
+                "partner_id": self.michel.id,
+                "group_id": contract_group.id,
+            },
+            [{"amount": 30.0}])
+        contract.contract_waiting()
+        invoices = contract.button_generate_invoices().invoice_ids.sorted(
+            "date_invoice")
+        self.assertFalse(contract.last_paid_invoice_date)
+        for invoice in invoices[:2]:
+            self._pay_invoice(invoice)
+        self.assertEqual(
+            contract.last_paid_invoice_date, invoices[1].date_invoice)
+        self.assertEqual(
+            contract_group.last_paid_invoice_date, invoices[1].date_invoice)
+        self.assertEqual(self.con_obj.search([
+            ("last_paid_invoice_date", "=", invoices[1].date_invoice),
+            ("id", "=", contract.id)]), contract)
+
+        invoices[1].payment_move_line_ids.remove_move_reconcile()
+        self.assertEqual(
+            contract.last_paid_invoice_date, invoices[0].date_invoice)
+        self.assertEqual(
+            contract_group.last_paid_invoice_date, invoices[0].date_invoice)
+
+    def test_nb_invoices(self):
+        """Invoices are counted once per contract, drafts and cancelled
+        invoices excluded."""
+        contract_group = self.create_group(
+            {"partner_id": self.michel.id, "advance_billing_months": 2})
+        contract = self.create_contract(
+            {
+                "partner_id": self.michel.id,
+                "group_id": contract_group.id,
+            },
+            [{"amount": 30.0}, {"amount": 20.0}])
+        contract2 = self.create_contract(
+            {
+                "partner_id": self.michel.id,
+                "group_id": contract_group.id,
+            },
+            [{"amount": 10.0}])
+        self.assertEqual(contract.nb_invoices, 0)
+        contracts = contract + contract2
+        contracts.contract_waiting()
+        invoices = contracts.button_generate_invoices().invoice_ids
+        # Both contracts share the same invoices
+        self.assertEqual(len(invoices), 3)
+        contracts.invalidate_cache(["nb_invoices"])
+        self.assertEqual(contracts.mapped("nb_invoices"), [3, 3])
+
+        invoices[0].action_invoice_cancel()
+        invoices[1].action_invoice_cancel()
+        invoices[1].action_invoice_draft()
+        contracts.invalidate_cache(["nb_invoices"])
+        self.assertEqual(contracts.mapped("nb_invoices"), [1, 1])
+
+    def test_contract_kpi(self):
+        """The current month and day KPIs count the newly activated
+        contracts."""
+        kpi_obj = self.env["recurring.contract.kpi"]
+
+        def current_kpi(period="month"):
+            kpi_obj.refresh_current_month()
+            domain = [("id", "<", 0), ("period", "=", period),
+                      ("product_id", "=", self.product.id)]
+            if period == "day":
+                domain.append(("date", "=", fields.Date.today()))
+            kpi = kpi_obj.search(domain)
+            return (sum(kpi.mapped("active_count")),
+                    sum(kpi.mapped("new_count")),
+                    sum(kpi.mapped("mrr")))
+
+        active, new, mrr = current_kpi()
+        day_active, day_new, day_mrr = current_kpi("day")
+        contract_group = self.create_group({"partner_id": self.michel.id})
+        contract = self.create_contract(
+            {
+                "partner_id": self.michel.id,
+                "group_id": contract_group.id,
+            },
+            [{"amount": 40.0}])
+        contract.force_activation()
+        new_active, new_new, new_mrr = current_kpi()
+        self.assertEqual(new_active, active + 1)
+        self.assertEqual(new_new, new + 1)
+        self.assertAlmostEqual(new_mrr, mrr + 40.0)
+        new_active, new_new, new_mrr = current_kpi("day")
+        self.assertEqual(new_active, day_active + 1)
+        self.assertEqual(new_new, day_new + 1)
+        self.assertAlmostEqual(new_mrr, day_mrr + 40.0)
+        # The history is readable and can be refreshed by the cron
+        kpi_obj.search([("id", ">", 0)], limit=1)
+        kpi_obj.cron_refresh()
+        kpi_obj.refresh_history()
+
+    def test_contract_arrears(self):
+        """The arrears are stored on the contract and follow the invoices."""
+        contract_group = self.create_group({"partner_id": self.michel.id})
+        contract = self.create_contract(
+            {
+                "partner_id": self.michel.id,
+                "group_id": contract_group.id,
+                "next_invoice_date": fields.Date.today() - relativedelta(
+                    months=3),
+            },
+            [{"amount": 20.0}])
+        contract.contract_waiting()
+        invoices = contract.button_generate_invoices().invoice_ids.filtered(
+            lambda i: i.date_due < fields.Date.today()).sorted("date_due")
+        self.assertEqual(len(invoices), 3)
+        self.assertEqual(contract.months_due, 3)
+        self.assertEqual(contract.oldest_open_due_date, invoices[0].date_due)
+        self.assertAlmostEqual(contract.open_amount, 60.0)
+        self.assertIn(contract, self.con_obj.search([("months_due", ">=", 3)]))
+
+        self._pay_invoice(invoices[0])
+        self.assertEqual(contract.months_due, 2)
+        self.assertEqual(contract.oldest_open_due_date, invoices[1].date_due)
+        self.assertAlmostEqual(contract.open_amount, 40.0)
+
+        invoices[1:].action_invoice_cancel()
+        self.assertEqual(contract.months_due, 0)
+        self.assertFalse(contract.oldest_open_due_date)
+        self.assertFalse(contract.open_amount)
+
+    def test_import_contracts(self):
+        """Contracts are imported in chunks and invalid rows are reported."""
+        self.product.default_code = "IMPORT-TEST"
+        rows = [
+            {"partner_id": self.michel.id, "group": "G1", "reference": "",
+             "product_code": "IMPORT-TEST", "amount": "10"},
+            {"partner_id": self.michel.id, "group": "G1",
+             "reference": "IMPORT-2", "product_id": self.product.id,
+             "amount": "20"},
+            {"partner_id": self.michel.id, "group": "G1",
+             "reference": "IMPORT-2", "product_id": self.product.id,
+             "amount": "5", "quantity": "2"},
+            {"partner_id": self.thomas.id, "reference": "IMPORT-3",
+             "product_code": "UNKNOWN", "amount": "10"},
+            {"partner_id": self.thomas.id, "reference": "IMPORT-4",
+             "product_id": self.product.id, "amount": "15",
+             "recurring_unit": "year"},
+        ]
+        result = self.con_obj.import_contracts(rows, chunk_size=2)
+        self.assertEqual([error[0] for error in result["errors"]], [4])
+        contracts = self.con_obj.browse(result["contract_ids"])
+        self.assertEqual(len(contracts), 3)
+        self.assertEqual(len(contracts.mapped("group_id")), 2)
+        self.assertTrue(contracts[0].reference.startswith("CON"))
+        self.assertEqual(contracts[1].total_amount, 30.0)
+        self.assertEqual(contracts[2].group_id.recurring_unit, "year")
+
+        # Big files are imported in jobs, keeping the groups together
+        chunks = self.con_obj._import_split_chunks(rows, 1)
+        self.assertEqual([len(chunk) for chunk in chunks], [2, 1, 1])
+        self.env["ir.config_parameter"].set_param(
+            "recurring_contract.job_chunk_size", "2")
+        for row in rows:
+            row["reference"] = row["reference"] and row["reference"] + "-JOB"
+        wizard = self.env["recurring.contract.import.wizard"].create({
+            "file_type": "jsonl",
+            "data_file": base64.b64encode("\n".join(
+                json.dumps(row) for row in rows).encode()),
+        })
+        wizard.import_contracts()
+        self.assertEqual(wizard.state, "progress")
+        self.assertEqual(wizard.nb_contracts, 4)
+        self.assertEqual(len(self.env["queue.job"].search([
+            ("func_string", "like", "_import_contracts_job")])), 2)
+        for chunk in self.con_obj._import_split_chunks(rows, 2):
+            self.con_obj._import_contracts_job(chunk, wizard.id)
+        self.assertEqual(wizard.state, "done")
+        self.assertEqual(wizard.nb_imported, 3)
+        self.assertIn("Row 4", wizard.error_log)
+
+    def test_bulk_transition(self):
+        """Contracts are activated in chunks with one digest message."""
+        contract_group = self.create_group({"partner_id": self.michel.id})
+        contracts = self.con_obj
+        for amount in (10.0, 20.0, 30.0):
+            contracts |= self.create_contract(
+                {
+                    "partner_id": self.michel.id,
+                    "group_id": contract_group.id,
+                },
+                [{"amount": amount}])
+        contracts[0].contract_waiting()
+        empty = self.create_contract(
+            {
+                "partner_id": self.michel.id,
+                "group_id": contract_group.id,
+                "contract_line_ids": [],
+            },
+            [])
+        with self.assertRaises(UserError):
+            (contracts | empty).bulk_transition("active")
+
+        self.env["ir.config_parameter"].set_param(
+            "recurring_contract.job_chunk_size", "2")
+        nb_messages = len(contracts[1].message_ids)
+        contracts.bulk_transition("active")
+        self.assertEqual(set(contracts.mapped("state")), {"active"})
+        self.assertTrue(all(contracts.mapped("activation_date")))
+        self.assertTrue(contracts[1].start_date)
+        # One digest for the validation and one for the activation
+        self.assertEqual(len(contracts[1].message_ids), nb_messages + 2)
+        self.assertEqual(len(contracts[0].message_ids.filtered(
+            lambda m: "activated at once" in m.body)), 1)
+
+        # Small selections are activated through the ORM by the wizard,
+        # and the hook is called as well.
+        contract = self.create_contract(
+            {
+                "partner_id": self.michel.id,
+                "group_id": contract_group.id,
+            },
+            [{"amount": 40.0}])
+        wizard = self.env["recurring.contract.activate.wizard"].create({})
+        with mock.patch.object(type(contract), "contracts_activated",
+                               autospec=True) as hook:
+            wizard.with_context(active_ids=contract.ids).activate_contract()
+        self.assertEqual(contract.state, "active")
+        self.assertEqual(hook.call_count, 1)
+        self.assertEqual(hook.call_args[0][0], contract)
+
+    def test_mass_terminate(self):
+        """Contracts are ended by chunks of groups with progress reporting."""
+        contracts = self.con_obj
+        for partner in (self.michel, self.michel, self.thomas):
+            contract_group = self.create_group({"partner_id": partner.id})
+            contracts |= self.create_contract(
+                {
+                    "partner_id": partner.id,
+                    "group_id": contract_group.id,
+                },
+                [{"amount": 10.0}])
+        contracts.force_activation()
+        contracts.mapped("group_id").with_context(
+            async_mode=False).generate_invoices()
+        self.env["ir.config_parameter"].set_param(
+            "recurring_contract.job_chunk_size", "2")
+        self.assertEqual(len(contracts._split_in_group_chunks()), 2)
+
+        end_reason = self.env["recurring.contract.end.reason"].create(
+            {"name": "Mass termination"})
+        wizard = self.env["end.contract.wizard"].with_context(
+            active_ids=contracts.ids, async_mode=False).create({
+                "end_reason_id": end_reason.id,
+                "end_date": fields.Datetime.now() - relativedelta(months=2),
+            })
+        # Invoices are cleaned from the termination, not from the end date
+        impact = contracts.estimate_clean_impact(
+            fields.Datetime.now(), clean_invoices_paid=True)
+        self.assertEqual(wizard.impact_invoice_count, impact["invoices"])
+        self.assertEqual(wizard.impact_line_count, impact["lines"])
+        wizard.end_contract()
+        self.assertEqual(set(contracts.mapped("state")), {"terminated"})
+        self.assertEqual(contracts.mapped("end_reason_id"), end_reason)
+        self.assertEqual(wizard.state, "done")
+        self.assertEqual(wizard.progress, 100.0)
+        self.assertFalse(contracts.mapped("invoice_line_ids").filtered(
+            lambda l: l.state == "open" and
+            l.due_date >= fields.Date.today()))
+
+        # Jobs don't depend on the wizard, which can be removed meanwhile
+        contract = self.create_contract(
+            {
+                "partner_id": self.thomas.id,
+                "group_id": contracts[-1].group_id.id,
+            },
+            [{"amount": 10.0}])
+        contract.force_activation()
+        wizard.unlink()
+        contract._end_contracts(
+            end_reason.id, fields.Datetime.now(), wizard_id=wizard.id)
+        self.assertEqual(contract.state, "terminated")
+
+    def test_archive_closed_contracts(self):
+        """Closed contracts are archived after the retention period."""
+        contract_group = self.create_group({"partner_id": self.michel.id})
+        contracts = self.con_obj
+        for amount in (10.0, 20.0):
+            contracts |= self.create_contract(
+                {
+                    "partner_id": self.michel.id,
+                    "group_id": contract_group.id,
+                },
+                [{"amount": amount}])
+        contracts.force_activation()
+        closed, running = contracts
+        with self.assertRaises(ValidationError):
+            running.toggle_active()
+        closed.action_contract_terminate()
+        closed.end_date = datetime.now() - relativedelta(days=10)
+        self.env["ir.config_parameter"].set_param(
+            "recurring_contract.archive_retention_days", "5")
+
+        self.assertEqual(self.con_obj.cron_archive_closed_contracts(), closed)
+        self.assertFalse(closed.active)
+        self.assertTrue(running.active)
+        self.assertEqual(contract_group.contract_ids, running)
+        self.assertFalse(self.con_obj.search([("id", "=", closed.id)]))
+        self.assertEqual(self.con_obj.with_context(active_test=False).search(
+            [("id", "=", closed.id)]), closed)
+
+    def test_reassign_partners(self):
+        """Contracts, groups and unpaid future invoices change partner."""
+        contract_group = self.create_group(
+            {"partner_id": self.michel.id, "advance_billing_months": 2})
+        contracts = self.con_obj
+        for amount in (10.0, 20.0):
+            contracts |= self.create_contract(
+                {
+                    "partner_id": self.michel.id,
+                    "group_id": contract_group.id,
+                },
+                [{"amount": amount}])
+        contracts.force_activation()
+        invoices = contract_group.with_context(
+            async_mode=False).generate_invoices().invoice_ids.sorted(
+                "date_invoice")
+        self._pay_invoice(invoices[-1])
+        invoices[1].action_invoice_cancel()
+        invoices[1].action_invoice_draft()
+        receivable = self.env["account.account"].create({
+            "code": "RCVREASSIGN",
+            "name": "Reassigned receivable",
+            "user_type_id": self.env.ref(
+                "account.data_account_type_receivable").id,
+            "reconcile": True,
+        })
+        david_company = self.david.commercial_partner_id
+        david_company.property_account_receivable_id = receivable
+        old_receivable = invoices[0].account_id
+
+        with self.assertRaises(UserError):
+            self.con_obj.reassign_partners({contracts[0].id: self.david.id})
+        credit_obj = self.env["recurring.partner.credit"]
+        with mock.patch.object(type(credit_obj), "refresh_open_credit",
+                               autospec=True) as refresh_credit:
+            moved = self.con_obj.reassign_partners(
+                {contract.id: self.david.id for contract in contracts})
+        self.assertEqual(contracts.mapped("partner_id"), self.david)
+        self.assertEqual(contract_group.partner_id, self.david)
+        self.assertEqual(moved, invoices.filtered(
+            lambda i: i.state in ("draft", "open") and
+            i.date_invoice >= fields.Date.today()))
+        self.assertIn(invoices[1], moved)
+        self.assertEqual(moved.mapped("partner_id"), self.david)
+        self.assertEqual(moved.mapped("commercial_partner_id"), david_company)
+        self.assertEqual(moved.mapped("account_id"), receivable)
+        move_lines = moved.mapped("move_id.line_ids")
+        self.assertEqual(move_lines.mapped("partner_id"), david_company)
+        self.assertIn(receivable, move_lines.mapped("account_id"))
+        self.assertNotIn(old_receivable, move_lines.mapped("account_id"))
+        self.assertEqual(invoices[-1].partner_id, self.michel)
+        self.assertEqual(invoices[-1].account_id, old_receivable)
+        refreshed_ids = refresh_credit.call_args[0][1]
+        self.assertTrue({self.michel.id, self.david.id,
+                         david_company.id} <= set(refreshed_ids))
+
+    def test_state_history(self):
+        """Each state change closes a period of the state history."""
+        history_obj = self.env["recurring.contract.state.history"]
+        contract_group = self.create_group({"partner_id": self.michel.id})
+        contract = self.create_contract(
+            {
+                "partner_id": self.michel.id,
+                "group_id": contract_group.id,
+            },
+            [{"amount": 10.0}])
+        self.assertEqual(contract.state_history_ids.mapped("state"), ["draft"])
+        counts = history_obj.count_by_state()
+
+        contract.force_activation()
+        contract.action_contract_terminate()
+        history = contract.state_history_ids.sorted("id")
+        self.assertEqual(history.mapped("state"),
+                         ["draft", "waiting", "active", "terminated"])
+        self.assertTrue(all(history[:-1].mapped("valid_to")))
+        self.assertFalse(history[-1].valid_to)
+        new_counts = history_obj.count_by_state()
+        self.assertEqual(new_counts["draft"], counts["draft"] - 1)
+        self.assertEqual(new_counts["terminated"],
+                         counts.get("terminated", 0) + 1)
+
+        self.env["ir.config_parameter"].set_param(
+            "recurring_contract.track_state", "False")
+        self.assertNotIn(
+            "state", contract._get_tracked_fields(["state"]))
+
+    def test_reconcile_batch_reports_failures(self):
+        """Invoice sets that cannot be reconciled are reported."""
+        partner = self.env["res.partner"].create({"name": "No credit"})
+        contract_group = self.create_group({"partner_id": partner.id})
+        contract = self.create_contract(
+            {
+                "partner_id": partner.id,
+                "group_id": contract_group.id,
+            },
+            [{"amount": 30.0}])
+        contract.contract_waiting()
+        invoice = contract.button_generate_invoices().invoice_ids[:1]
+        nb_messages = len(invoice.message_ids)
+
+        failed = self.env["account.invoice"]._group_or_split_reconcile_batch(
+            [invoice.ids])
+        self.assertEqual(failed, [invoice.ids])
+        self.assertEqual(len(invoice.message_ids), nb_messages + 1)
+        self.assertEqual(invoice.state, "open")
@@ -1,3 +1,6 @@
 from . import recurring_invoicer_wizard
 from . import contract_activation_wizard
 from . import end_contract_wizard
+from . import contract_line_reprice_wizard
+from . import contract_import_wizard
+from . import contract_reassign_wizard
@@ -18,7 +18,12 @@ class ActivateContractWizard(models.TransientModel):
 
     @api.multi
     def activate_contract(self):
-        contract_obj = self.env['recurring.contract']
-        contract_obj.browse(self.env.context.get('active_ids')) \
-            .force_activation()
+        contracts = self.env['recurring.contract'].browse(
+            self.env.context.get('active_ids'))
+        group_obj = self.env['recurring.contract.group']
+        if len(contracts) > group_obj._get_job_chunk_size():
+            # Too many contracts for one transaction: activate them in jobs
+            contracts.with_context(async_mode=True).bulk_transition('active')
+        else:
+            contracts.force_activation()
         return True
@@ -0,0 +1,116 @@
+##############################################################################
+#
+#    Copyright (C) 2021 Compassion CH (http://www.compassion.ch)
+#    Releasing children from poverty in Jesus' name
+#
+#    The licence is in the file __manifest__.py
+#
+##############################################################################
+
+import base64
+import csv
+import io
+import json
+
+from odoo import models, fields, api, _
+
+
+class ContractImportWizard(models.TransientModel):
+    """ This wizard creates contracts from a CSV or JSON lines file.
+    Each row of the file describes one contract line. """
+    _name = 'recurring.contract.import.wizard'
+    _description = 'Recurring contract import wizard'
+
+    data_file = fields.Binary('File', required=True)
+    file_name = fields.Char()
+    file_type = fields.Selection([
+        ('csv', 'CSV'),
+        ('jsonl', 'JSON lines'),
+    ], default='csv', required=True)
+    state = fields.Selection([
+        ('draft', 'Draft'),
+        ('progress', 'In progress'),
+        ('done', 'Done'),
+    ], default='draft')
+    nb_contracts = fields.Integer('Contracts to import', readonly=True)
+    nb_processed = fields.Integer('Processed contracts', readonly=True)
+    nb_imported = fields.Integer('Imported contracts', readonly=True)
+    error_log = fields.Text('Errors', readonly=True)
+    progress = fields.Float(compute='_compute_progress')
+
+    @api.multi
+    def _compute_progress(self):
+        for wizard in self:
+            wizard.progress = wizard.nb_contracts and \
+                wizard.nb_processed * 100.0 / wizard.nb_contracts
+
+    @api.multi
+    def import_contracts(self):
+        """ Import the contracts at once, or in jobs by chunks of groups
+        for files bigger than the job chunk size. The progress of the jobs
+        is reported on the wizard. """
+        self.ensure_one()
+        contract_obj = self.env['recurring.contract']
+        rows = list(self._read_rows())
+        size = self.env['recurring.contract.group']._get_job_chunk_size()
+        if len(rows) > size and self.env.context.get('async_mode', True):
+            chunks = contract_obj._import_split_chunks(rows, size)
+            self.write({
+                'state': 'progress',
+                'nb_contracts': sum(len(chunk) for chunk in chunks),
+                'nb_processed': 0,
+                'nb_imported': 0,
+                'error_log': False,
+            })
+            for chunk in chunks:
+                contract_obj.with_delay()._import_contracts_job(
+                    chunk, self.id)
+        else:
+            result = contract_obj.import_contracts(rows)
+            self.write({
+                'state': 'done',
+                'nb_imported': len(result['contract_ids']),
+                'error_log': self._format_errors(result['errors']),
+            })
+        return self.refresh_progress()
+
+    @api.multi
+    def refresh_progress(self):
+        """ Open again the wizard to display the result of the import. """
+        self.ensure_one()
+        return {
+            'name': _('Import contracts'),
+            'type': 'ir.actions.act_window',
+            'res_model': self._name,
+            'res_id': self.id,
+            'view_mode': 'form',
+            'view_type': 'form',
+            'target': 'new',
+        }
+
+    @api.model
+    def _format_errors(self, errors):
+        """
+        :param errors: list of (row number, message)
+        :return: text listing the errors
+        """
+        return "\n".join(_("Row %s: %s") % tuple(error) for error in errors)
+
+    def _read_rows(self):
+        """ Read the file row by row, so that contracts can be created
+        while the file is read.
+        :return: generator of dicts (None for unreadable rows)
+        """
+        data = io.TextIOWrapper(
+            io.BytesIO(base64.b64decode(self.data_file)),
+            encoding='utf-8-sig')
+        if self.file_type == 'csv':
+            yield from csv.DictReader(data)
+        else:
+            for line in data:
+                if not line.strip():
+                    continue
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    yield None
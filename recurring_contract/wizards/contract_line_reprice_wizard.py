@@ -0,0 +1,34 @@
+##############################################################################
+#
+#    Copyright (C) 2021 Compassion CH (http://www.compassion.ch)
+#    Releasing children from poverty in Jesus' name
+#
+#    The licence is in the file __manifest__.py
+#
+##############################################################################
+
+from odoo import models, fields, api
+
+
+class ContractLineRepriceWizard(models.TransientModel):
+    """ This wizard changes the price of a product in all running
+    contracts. """
+    _name = 'recurring.contract.line.reprice.wizard'
+    _description = 'Recurring contract line reprice wizard'
+
+    product_id = fields.Many2one(
+        'product.product', 'Product', required=True, readonly=False)
+    old_price = fields.Float(required=True)
+    new_price = fields.Float(required=True)
+    effective_date = fields.Date(default=fields.Date.today, required=True)
+
+    @api.multi
+    def reprice(self):
+        line_obj = self.env['recurring.contract.line']
+        args = (self.product_id, self.old_price, self.new_price,
+                self.effective_date)
+        if self.env.context.get('async_mode', True):
+            line_obj.with_delay()._reprice_job(*args)
+        else:
+            line_obj.reprice(*args)
+        return True
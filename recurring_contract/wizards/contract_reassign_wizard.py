@@ -0,0 +1,33 @@
+##############################################################################
+#
+#    Copyright (C) 2021 Compassion CH (http://www.compassion.ch)
+#    Releasing children from poverty in Jesus' name
+#
+#    The licence is in the file __manifest__.py
+#
+##############################################################################
+
+from odoo import models, fields, api
+
+
+class ContractReassignWizard(models.TransientModel):
+    """ This wizard moves the selected contracts and their payment options
+    to another partner. """
+    _name = 'recurring.contract.reassign.wizard'
+    _description = 'Recurring contract partner reassignment wizard'
+
+    contract_ids = fields.Many2many(
+        'recurring.contract', string='Contracts',
+        default=lambda self: self.env.context.get('active_ids'),
+        readonly=False)
+    partner_id = fields.Many2one(
+        'res.partner', 'New partner', required=True, readonly=False)
+
+    @api.multi
+    def reassign(self):
+        self.ensure_one()
+        self.env['recurring.contract'].reassign_partners({
+            contract_id: self.partner_id.id
+            for contract_id in self.contract_ids.ids
+        })
+        return True
@@ -7,9 +7,7 @@
 #    The licence is in the file __manifest__.py
 #
 ##############################################################################
-from datetime import datetime
-
-from odoo import models, fields, api
+from odoo import models, fields, api, _
 
 
 class EndContractWizard(models.TransientModel):
@@ -23,20 +21,73 @@ class EndContractWizard(models.TransientModel):
         'recurring.contract.end.reason', required=True, readonly=False)
     end_date = fields.Datetime(default=fields.Datetime.now, required=True)
     additional_notes = fields.Text()
+    impact_invoice_count = fields.Integer(
+        'Invoices to clean', compute='_compute_clean_impact')
+    impact_line_count = fields.Integer(
+        'Invoice lines to clean', compute='_compute_clean_impact')
+    impact_reconcile_count = fields.Integer(
+        'Reconciliations to undo', compute='_compute_clean_impact')
+    state = fields.Selection([
+        ('draft', 'Draft'),
+        ('progress', 'In progress'),
+        ('done', 'Done'),
+    ], default='draft', readonly=True)
+    nb_contracts = fields.Integer(readonly=True)
+    nb_processed = fields.Integer('Processed contracts', readonly=True)
+    progress = fields.Float(compute='_compute_progress')
+
+    @api.depends('contract_ids', 'end_date')
+    def _compute_clean_impact(self):
+        for wizard in self:
+            # Invoices are cleaned from the moment contracts are terminated:
+            # now, or by the CRON when the end date is in the future.
+            now = fields.Datetime.now()
+            clean_date = max(wizard.end_date or now, now)
+            impact = wizard.contract_ids.estimate_clean_impact(
+                clean_date, clean_invoices_paid=True)
+            wizard.impact_invoice_count = impact['invoices']
+            wizard.impact_line_count = impact['lines']
+            wizard.impact_reconcile_count = impact['reconciles']
+
+    @api.multi
+    def _compute_progress(self):
+        for wizard in self:
+            wizard.progress = wizard.nb_contracts and \
+                wizard.nb_processed * 100.0 / wizard.nb_contracts
 
     @api.multi
     def end_contract(self):
-        # Terminate contracts
-        self.contract_ids.write({
-            'end_reason_id': self.end_reason_id.id,
-            'end_date': self.end_date
+        """ End the contracts in jobs by chunks of payment options. The
+        progress of the jobs is reported on the wizard, as long as it is
+        not removed by the vacuum. """
+        self.ensure_one()
+        self.write({
+            'state': 'progress',
+            'nb_contracts': len(self.contract_ids),
+            'nb_processed': 0,
         })
-        if self.additional_notes:
-            self.contract_ids.message_post(body=self.additional_notes)
-        now = datetime.now()
-        end_date = self.end_date
-        if end_date > now:
-            # The contract will be ended by CRON later
+        async_mode = self.env.context.get('async_mode', True)
+        args = (self.end_reason_id.id, self.end_date, self.additional_notes,
+                self.id)
+        for contracts in self.contract_ids._split_in_group_chunks():
+            if async_mode:
+                contracts.with_delay()._end_contracts_job(*args)
+            else:
+                contracts._end_contracts(*args)
+        if not async_mode:
             return True
-        else:
-            return self.contract_ids.action_contract_terminate()
+        return self.refresh_progress()
+
+    @api.multi
+    def refresh_progress(self):
+        """ Open again the wizard to display the progress of the jobs. """
+        self.ensure_one()
+        return {
+            'name': _('End contract'),
+            'type': 'ir.actions.act_window',
+            'res_model': self._name,
+            'res_id': self.id,
+            'view_mode': 'form',
+            'view_type': 'form',
+            'target': 'new',
+        }